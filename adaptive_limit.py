@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Limit the number of checks run at the same time against each database,
+adjusting the limit as the run goes along (additive increase, multiplicative
+decrease). The limit goes up by 1/limit after each check that completes
+without its connect or query latency climbing (so by about one for each
+round of checks), and is halved when latency climbs or an error suggesting
+the database is overloaded is seen.
+
+v0.1 initial version
+"""
+from __future__ import print_function
+import threading
+import time
+
+# Latency more than this times the best seen so far counts as climbing
+LATENCY_TOLERANCE = 2.0
+# Latencies below this (seconds) never count as climbing, too short to tell
+MIN_LATENCY = 0.05
+
+# Oracle errors that mean the database or listener is too busy
+OVERLOAD_ERRORS = ("ORA-00018",# maximum number of sessions exceeded
+                   "ORA-00020",# maximum number of processes exceeded
+                   "ORA-12170",# connect timeout
+                   "ORA-12516",# listener could not find handler
+                   "ORA-12518",# listener could not hand off connection
+                   "ORA-12519",# no appropriate service handler
+                   "ORA-12520",# no handler for server type
+                   "ORA-12528",# instance blocking new connections
+                   )
+
+
+class AdaptiveLimit(object):
+    def __init__(self, maximum, initial=1):
+        """Concurrency limit for a single database
+        Args:
+            maximum (int) - highest limit allowed
+            initial (int) - starting limit
+        """
+        self.maximum = maximum
+        self.limit = float(min(initial, maximum))
+        self.active = 0
+        self.condition = threading.Condition()
+        # (phase, key) -> best latency
+        self.latencies = {}
+        # Time of last decrease. Checks started before this don't
+        # cause another decrease (they were started under the old limit)
+        self.decreased = 0.0
+
+    def acquire(self):
+        """Wait until a check can be started. Returns token for release()"""
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+            return time.time()
+
+    def try_acquire(self):
+        """Start a check if limit allows, without waiting.
+        Returns token for release(), or None if limit reached"""
+        with self.condition:
+            if self.active >= int(self.limit):
+                return None
+            self.active += 1
+            return time.time()
+
+    def release(self, token, latencies=(), errors=()):
+        """Finish check and adjust limit based on how it went
+        Args:
+            token - value returned by acquire()
+            latencies - sequence of (phase, key, seconds), key separates
+                        latencies which can't be compared e.g. different SQL
+            errors - error messages from the check
+        """
+        with self.condition:
+            self.active -= 1
+            congested = any(code in str(error) for error in errors
+                            for code in OVERLOAD_ERRORS)
+            for phase, key, seconds in latencies:
+                if seconds is not None and self.observe((phase, key), seconds):
+                    congested = True
+            if congested:
+                if token >= self.decreased:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.decreased = time.time()
+            elif not errors:
+                self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+    def observe(self, key, seconds):
+        """Add latency observation. Returns True if latency of this check
+        is well above the best seen"""
+        best = self.latencies.get(key)
+        if best is None or seconds < best:
+            self.latencies[key] = seconds
+            return False
+        return seconds > max(best * LATENCY_TOLERANCE, MIN_LATENCY)
+
+
+class AdaptiveLimits(object):
+    def __init__(self, maximum, initial=1):
+        """Separate AdaptiveLimit for each database, created when first needed
+        Args:
+            maximum (int) - highest limit for any one database
+            initial (int) - starting limit for each database
+        """
+        self.maximum = maximum
+        self.initial = initial
+        self.limits = {}
+        self.lock = threading.Lock()
+
+    def get(self, database):
+        """Returns AdaptiveLimit for database"""
+        with self.lock:
+            if database not in self.limits:
+                self.limits[database] = AdaptiveLimit(self.maximum, self.initial)
+            return self.limits[database]
+
+    def current(self):
+        """Returns dict of current limit for each database"""
+        with self.lock:
+            return {database:int(limit.limit) for database, limit in self.limits.items()}
+
+
+# Example - latency climbs once more than 4 checks run at once
+if __name__ == "__main__":
+    limit = AdaptiveLimit(maximum=10)
+
+    def check():
+        token = limit.acquire()
+        latency = 0.1 * max(1, limit.active - 3)
+        time.sleep(latency)
+        limit.release(token, [("query", "example", latency)])
+
+    threads = [threading.Thread(target=check) for _ in range(60)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print("Final limit:", int(limit.limit))
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+"""
+Translate simple Result Condition expressions (as used by
+database_check_excel.py) into SQL so the number of rows breaking the
+condition can be counted on the database server instead of fetching
+every row.
+
+Result Conditions are applied to each cell, with x as the cell value and c
+as its column position (starting from 1). A row breaks the condition if it's
+true, or raises an exception, for any of its cells. NULL values are treated
+as None is in Python, so e.g. x != "A" is true for NULL and x < 5 raises.
+Translation is done for each column in turn, with comparisons on c worked
+out here and comparisons on x turned into SQL.
+
+Only simple conditions can be translated: comparisons (==, !=, <, <=, >, >=,
+is, is not) between x or c and a number, string or None, combined with
+and/or/not. Anything else raises ValueError. So does comparing x with an
+empty string (Oracle treats '' as NULL) or with a literal whose type doesn't
+match the column's (Oracle converts types where Python wouldn't), as the
+SQL would then give a different answer from Python.
+
+v0.1 initial version
+"""
+from __future__ import print_function
+import ast
+
+# SQL equivalent of each Python comparison operator
+SQL_OPERATORS = {ast.Eq:"=", ast.NotEq:"<>", ast.Lt:"<", ast.LtE:"<=",
+                 ast.Gt:">", ast.GtE:">=", ast.Is:"=", ast.IsNot:"<>"}
+
+# SQL operator with its operands swapped round
+REVERSED_OPERATORS = {"<":">", "<=":">=", ">":"<", ">=":"<="}
+# SQL operator giving the opposite result (for non-NULL values)
+NEGATED_OPERATORS = {"=":"<>", "<>":"=", "<":">=", "<=":">", ">":"<=", ">=":"<"}
+
+# Column kinds (see column_to_sql()) that can be compared with each type
+# of literal. CHAR columns aren't included as Oracle ignores trailing
+# spaces when comparing them and Python doesn't.
+LITERAL_KINDS = {str:"string", int:"number", float:"number"}
+# Kind given when column types aren't known and not to be checked
+ANY_KIND = "any"
+
+# Markers returned by operand() for the names x and c (so they can't be
+# confused with literal strings "x" and "c")
+X = object()
+C = object()
+
+# Python functions used to compare c with a number
+PYTHON_OPERATORS = {ast.Eq:lambda a, b: a == b,
+                    ast.NotEq:lambda a, b: a != b,
+                    ast.Lt:lambda a, b: a < b,
+                    ast.LtE:lambda a, b: a <= b,
+                    ast.Gt:lambda a, b: a > b,
+                    ast.GtE:lambda a, b: a >= b}
+
+
+def condition_to_sql(condition, headings, kinds=None):
+    """Translate a Result Condition into a SQL predicate that is true
+    for rows where the condition is true, or would raise an exception, for
+    any cell (NULL values treated as None is in Python).
+    Args:
+        condition (str) - Python expression using x and c
+        headings - column names of the query results
+        kinds - optional kind of each column ("number", "string" or None
+                if something else, see dbcon_multi.column_kind()). When
+                not given, types aren't checked (only useful for checking
+                if a condition has a form that can be translated).
+    Returns:
+        SQL predicate (str)
+    Raises:
+        ValueError if condition can't be translated
+    """
+    try:
+        tree = ast.parse(condition.strip(), mode="eval").body
+    except SyntaxError as err:
+        raise ValueError("Invalid condition: " + str(err))
+    clauses = []
+    if kinds is None:
+        kinds = [ANY_KIND] * len(headings)
+    for c, (heading, kind) in enumerate(zip(headings, kinds), start=1):
+        # Cell flagged unless condition is definitely false for it
+        clause = not_sql(translate(tree, c, quote_identifier(heading), kind)[1])
+        # Condition true for every row whatever its values
+        if clause is True:
+            return "1 = 1"
+        if clause is not False:
+            clauses.append(clause)
+    if not clauses:
+        return "1 = 0"
+    return join_parts(clauses, " OR ")
+
+
+def aggregate_sql(sql, predicate):
+    """Wrap query so it returns number of rows and number of rows where
+    predicate is true (columns TOTAL_ROWS, FLAGGED_ROWS)"""
+    return ("SELECT COUNT(*) AS TOTAL_ROWS,"
+            " COALESCE(SUM(CASE WHEN {} THEN 1 ELSE 0 END), 0) AS FLAGGED_ROWS"
+            " FROM ({}) q".format(predicate, strip_sql(sql)))
+
+
+def describe_sql(sql):
+    """Wrap query so it returns its column headings but no rows"""
+    return "SELECT * FROM ({}) q WHERE 1 = 0".format(strip_sql(sql))
+
+
+def strip_sql(sql):
+    """Remove trailing whitespace and semicolon so query can be a subquery"""
+    return sql.strip().rstrip(";").rstrip()
+
+
+def quote_identifier(name):
+    """Quote column name for use in SQL"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def sql_literal(value):
+    """Returns SQL literal for a number or string value"""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError("Can't translate value {!r}".format(value))
+    if isinstance(value, str):
+        # Oracle treats '' as NULL, so comparisons with it are never true
+        if not value:
+            raise ValueError("Can't translate comparison with empty string")
+        return "'" + value.replace("'", "''") + "'"
+    return repr(value)
+
+
+def translate(node, c, column, kind):
+    """Translate part of a condition for a particular column
+    Args:
+        node - ast node of condition
+        c (int) - column position
+        column (str) - quoted column name
+        kind (str) - kind of column, see condition_to_sql()
+    Returns:
+        pair of predicates (true, false), for when the part is true and
+        when it's false in Python. Neither is true when Python would raise
+        an exception. Each is either SQL (str) which is never NULL, or
+        True/False if it doesn't depend on x.
+    """
+    if isinstance(node, ast.BoolOp):
+        # Generator, so parts Python wouldn't evaluate aren't translated
+        pairs = (translate(value, c, column, kind) for value in node.values)
+        if isinstance(node.op, ast.And):
+            return and_pairs(pairs)
+        # a or b - true if a is, or a is false and b is true
+        true, false = next(pairs)
+        while true is not True:
+            try:
+                next_true, next_false = next(pairs)
+            except StopIteration:
+                break
+            true = or_sql([true, and_sql([false, next_true])])
+            false = and_sql([false, next_false])
+        return true, false
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        true, false = translate(node.operand, c, column, kind)
+        return false, true
+
+    if isinstance(node, ast.Compare):
+        # Chained comparisons (e.g. 1 < x < 5) are pairs joined by and
+        operands = [node.left] + node.comparators
+        return and_pairs(compare(op, operands[i], operands[i+1], c, column, kind)
+                         for i, op in enumerate(node.ops))
+
+    if isinstance(node, ast.Constant) and isinstance(node.value, bool):
+        return node.value, not node.value
+
+    raise ValueError("Can't translate " + ast.dump(node))
+
+
+def and_pairs(pairs):
+    """Combine (true, false) predicate pairs as Python and does. Later
+    parts are only evaluated if earlier ones are true, so pairs is
+    only consumed until the result is known to be false."""
+    pairs = iter(pairs)
+    true, false = next(pairs)
+    while true is not False:
+        try:
+            next_true, next_false = next(pairs)
+        except StopIteration:
+            break
+        false = or_sql([false, and_sql([true, next_false])])
+        true = and_sql([true, next_true])
+    return true, false
+
+
+def and_sql(parts):
+    """Combine predicates (SQL or True/False) with AND"""
+    if False in parts:
+        return False
+    parts = [part for part in parts if part is not True]
+    if not parts:
+        return True
+    return join_parts(parts, " AND ")
+
+
+def or_sql(parts):
+    """Combine predicates (SQL or True/False) with OR"""
+    if True in parts:
+        return True
+    parts = [part for part in parts if part is not False]
+    if not parts:
+        return False
+    return join_parts(parts, " OR ")
+
+
+def not_sql(part):
+    """Negate predicate (SQL or True/False)"""
+    if isinstance(part, bool):
+        return not part
+    return "NOT (" + part + ")"
+
+
+def join_parts(parts, joiner):
+    """Join SQL parts with AND/OR, bracketing them if more than one"""
+    if len(parts) == 1:
+        return parts[0]
+    return joiner.join("(" + part + ")" for part in parts)
+
+
+def compare(op, left, right, c, column, kind):
+    """Translate single comparison between two operands.
+    Returns (true, false) predicate pair, see translate()"""
+    left, right = operand(left), operand(right)
+    names = [side for side in (left, right) if side is X or side is C]
+    # Comparison between c and a number - work it out now
+    if names == [C]:
+        if type(op) not in PYTHON_OPERATORS:
+            raise ValueError("Can't translate comparison with c")
+        values = [c if side is C else side for side in (left, right)]
+        if not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+            raise ValueError("c can only be compared with a number")
+        result = PYTHON_OPERATORS[type(op)](*values)
+        return result, not result
+
+    # Comparison between x and a literal
+    if names == [X]:
+        literal = right if left is X else left
+        op_type = type(op)
+        if literal is None:
+            if op_type in (ast.Eq, ast.Is):
+                return column + " IS NULL", column + " IS NOT NULL"
+            if op_type in (ast.NotEq, ast.IsNot):
+                return column + " IS NOT NULL", column + " IS NULL"
+            raise ValueError("Can't translate comparison with None")
+        if op_type not in SQL_OPERATORS or op_type in (ast.Is, ast.IsNot):
+            raise ValueError("Can't translate operator " + op_type.__name__)
+        if kind != ANY_KIND and LITERAL_KINDS.get(type(literal)) != kind:
+            raise ValueError("Can't compare {} column with {!r}".format(kind or "this", literal))
+        sql_op = SQL_OPERATORS[op_type]
+        # Literal on the left, so reverse direction of < and >
+        if left is not X:
+            sql_op = REVERSED_OPERATORS.get(sql_op, sql_op)
+        literal = sql_literal(literal)
+        true = "{} {} {}".format(column, sql_op, literal)
+        false = "{} {} {}".format(column, NEGATED_OPERATORS[sql_op], literal)
+        # None (NULL) == literal is False and None != literal is True.
+        # Other comparisons with None raise TypeError, so neither.
+        not_null = column + " IS NOT NULL AND "
+        is_null = column + " IS NULL OR "
+        if sql_op == "=":
+            return not_null + true, is_null + false
+        if sql_op == "<>":
+            return is_null + true, not_null + false
+        return not_null + true, not_null + false
+
+    raise ValueError("Can't translate comparison")
+
+
+def operand(node):
+    """Returns X or C for those names, otherwise the literal value"""
+    if isinstance(node, ast.Name) and node.id in ("x", "c"):
+        return X if node.id == "x" else C
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = operand(node.operand)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return -value
+    if isinstance(node, ast.Constant):
+        return node.value
+    raise ValueError("Can't translate " + ast.dump(node))
+
+
+# Examples, then check SQL flags the same rows as Python does (using sqlite)
+if __name__ == "__main__":
+    import sqlite3
+    headings = ["OWNER", "TABLE_NAME"]
+    for condition in ['c == 2 and x=="FRED"',
+                      '(c==1 and x!="SYS") or (c==2 and x=="DUAL")',
+                      "x is None",
+                      "x == 'x' or 5 > x",
+                      "c == 1 and 0 < x <= 10",
+                      "x"]:
+        try:
+            print(condition, "->", condition_to_sql(condition, headings))
+        except ValueError as err:
+            print(condition, "->", err)
+
+    def python_flagged(condition, row):
+        """True if condition true or raises exception for any cell in row"""
+        for c, x in enumerate(row, start=1):
+            try:
+                if eval(condition):
+                    return True
+            except Exception:
+                return True
+        return False
+
+    headings = ["NAME", "SIZE"]
+    kinds = ["string", "number"]
+    rows = [("A", 1), (None, 2), ("A", None), ("B", 20), (None, None)]
+    db = sqlite3.connect(":memory:")
+    db.execute('CREATE TABLE t ("NAME" TEXT, "SIZE" INTEGER)')
+    db.executemany("INSERT INTO t VALUES (?, ?)", rows)
+    for condition in ['c == 1 and x != "A"',
+                      'c == 1 and not (x == "A")',
+                      "c == 2 and x < 5",
+                      "c == 2 and not x >= 5",
+                      'c == 1 and (x == "A" or x == "B")',
+                      "c == 2 and (x is None or x > 10)",
+                      "c == 2 and x is not None and x > 10",
+                      'c == 2 and 1 < x < 5']:
+        predicate = condition_to_sql(condition, headings, kinds)
+        sql_rows = [bool(flagged) for (flagged,) in
+                    db.execute("SELECT CASE WHEN {} THEN 1 ELSE 0 END FROM t".format(predicate))]
+        python_rows = [python_flagged(condition, row) for row in rows]
+        print("OK  " if sql_rows == python_rows else "FAIL", condition)
+
+    # Oracle would give different answers from Python for these, so they
+    # must not be translated (all rows fetched instead)
+    for condition in ['c == 1 and x != ""',
+                      'c == 2 and x != "5"',
+                      "c == 1 and x > 10",
+                      'x == "A"']:
+        try:
+            condition_to_sql(condition, headings, kinds)
+        except ValueError as err:
+            print("OK  ", condition, "-", err)
+        else:
+            print("FAIL", condition, "- translated")
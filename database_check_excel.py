@@ -7,13 +7,17 @@ Should work with Python 3 or Python 2 but best with 3.
 """
 
 from __future__ import print_function
+import time
+#Used to report how long the script's own imports take (--profile-startup)
+IMPORT_START = time.time()
 import datetime
 import os
-import time
+import io
 import getpass
 
-#Used to read command-line args (sys.argv)
+#Used to read command-line args
 import sys
+import argparse
 
 # Used to run database checks in parallel
 # Note "queue" module in Python 3 was called "Queue" In Python 2
@@ -23,20 +27,73 @@ try:
 except ImportError:
     import Queue as queue
 import threading
+#Used to write results copy of spreadsheet in background
+import multiprocessing
+#Used to report exceptions in writer thread
+import traceback
 
 #Used to find host name and IP address of PC
 import socket
 
-# Spreadsheet handling
-import openpyxl
-from openpyxl.utils import column_index_from_string, get_column_letter
-from openpyxl.utils.exceptions import IllegalCharacterError
+# Spreadsheet handling - openpyxl is slow to import so this is done by
+# load_openpyxl() when the first spreadsheet is opened, not at startup.
+openpyxl = None
+column_index_from_string = get_column_letter = IllegalCharacterError = None
 
 # Manages Database connection and runs queries
-from dbcon_multi import DbCon
+# (database driver modules are imported when first used)
+from dbcon_multi import DbCon, load_driver
+# Translates Result Conditions to SQL for Aggregate mode
+from condition_sql import condition_to_sql, aggregate_sql, describe_sql
+# Keeps results within memory budget
+from result_spool import MemoryBudget
+# Adjusts number of checks run at once against each database
+from adaptive_limit import AdaptiveLimits
+# Optional Prometheus metrics for the run
+from run_metrics import RunMetrics
+
+# Metric outcome names for each result fill colour index
+CHECK_OUTCOMES = {0:"error", 1:"pass", 4:"condition_failed", 5:"condition_exception"}
+
+# Result fill colour indexes from worst to best. When a row is run against a
+# group of databases the row gets the worst colour of the group.
+COLOUR_SEVERITY = [0, 5, 4, 1]
+
+# Separator for listing several databases in a single Database cell
+# (comma can't be used as it's part of direct connection names)
+DATABASE_SEPARATOR = ";"
+
+# Widest column (in characters) set when sizing columns to fit results
+MAX_COLUMN_WIDTH = 50
+
+# SQL run when SQL column not present
+DEFAULT_SQL = "SELECT SYSDATE FROM DUAL"
+
+# Tab where statistics and plans of slow queries are written
+SLOW_QUERIES_TAB = "Slow Queries"
+# Headings on slow queries tab, with key of each value in DbCon.profile["stats"]
+SLOW_QUERY_STATS = [("DB Time (s)", "db_time"), ("CPU (s)", "cpu_time"),
+                    ("Logical Reads", "logical_reads"), ("Physical Reads", "physical_reads"),
+                    ("Rows Fetched", "rows_fetched"), ("Cursor Executions", "executions")]
+SLOW_QUERY_HEADINGS = (["Date/Time", "Tab", "Row", "Heading", "Database", "Username",
+                        "Query Time (s)", "SQL ID"]
+                       + [heading for heading, key in SLOW_QUERY_STATS]
+                       + ["SQL Run", "Plan", "Errors"])
+
+# Time (seconds) a worker waits for a new check before retrying checks put
+# aside because their database was at its adaptive concurrency limit
+DEFERRED_RETRY = 0.1
+
+# Maximum time (seconds) to wait for host IP address lookup when saving
+HOST_LOOKUP_TIMEOUT = 5
+
+IMPORT_TIME = time.time() - IMPORT_START
 
 class SpreadsheetRun:
-    def __init__(self, filename="", odbc_driver="Oracle in instantclient11_1"):
+    def __init__(self, filename="", odbc_driver="Oracle in instantclient11_1",
+                 metrics=None, validate_only=False, max_workers=0,
+                 memory_budget=None, background_save=False,
+                 concurrency_limits=None, slow_query_time=None):
         """Tries to connect to multiple databases using details in specially
         formatted spreadsheet (database_check.xlsx).
         Success/fail for each recorded in spreadsheet and separate copy of
@@ -47,9 +104,63 @@ class SpreadsheetRun:
             odbc_driver - (optional) Name of odbc driver to
             be used in database connection string. Only needed if
             odbc connection specified in spreadsheet (can use cx_Oracle instead)
+            metrics - (optional) run_metrics.RunMetrics object. When supplied
+            check results, database latencies, queue depth, active workers
+            and run duration are recorded in it.
+            validate_only (bool) - (optional) when True, only read the
+            spreadsheet and report problems with it (see self.validate()).
+            No database connections are made and nothing is saved.
+            max_workers (int) - (optional) number of worker threads that run
+            the checks. Checks waiting for a worker are held in a queue of
+            limited size, so reading rows pauses while it's full. 0 (default)
+            starts a thread for every check as its row is read.
+            memory_budget - (optional) result_spool.MemoryBudget shared by
+            all checks. Results that don't fit are moved to temporary files
+            until written to the spreadsheet.
+            background_save (bool) - (optional) when True and the main
+            spreadsheet is updated, the results copy of the spreadsheet is
+            written by a separate process (held in self.save_process), so
+            the caller can move on to the next spreadsheet. Caller should
+            join() the process and check its exitcode before exiting.
+            concurrency_limits - (optional) adaptive_limit.AdaptiveLimits
+            shared by all checks. Limits the number of checks running at
+            once against each database, raising the limit while latency
+            stays flat and lowering it when latency climbs or overload
+            errors appear.
+            slow_query_time (float) - (optional) queries taking at least
+            this many seconds have their statistics and execution plan
+            written to the Slow Queries tab (see self.write_slow_query()).
         """
+        #Used to time the whole run (recorded in metrics)
+        run_start = time.time()
+        self.filename = filename
+        self.metrics = metrics
+
+        load_openpyxl()
+
         #Create queue to hold database checks to be handled in multi-thread run
-        self.queue = queue.Queue()
+        #Limited in size when there's a fixed number of workers, so reading
+        #of rows waits for workers to catch up.
+        self.max_workers = max_workers
+        self.queue = queue.Queue(maxsize=max_workers * 2)
+
+        #Queue of finished checks waiting to be written to spreadsheet by
+        #self.writer_loop(). Also limited so checks wait for the writer.
+        self.write_queue = queue.Queue(maxsize=max_workers * 2)
+        self.memory_budget = memory_budget
+        self.concurrency_limits = concurrency_limits
+        #Checks put aside by workers while their database is at its limit
+        self.deferred = []
+        self.deferred_lock = threading.Lock()
+        self.slow_query_time = slow_query_time
+
+        self.background_save = background_save
+        #Tabs created by the script during run (see self.write_results_table())
+        self.created_tabs = set()
+
+        #Process writing results copy when background_save used
+        self.save_process = None
+        self.results_file = ""
 
         # Optional global password value
         # If no password found in spreadsheet, getpass.getpass will be used to
@@ -63,6 +174,9 @@ class SpreadsheetRun:
         #Holds number of errors found on each spreadsheet tab
         self.tab_error_counts = {}
 
+        #Holds problems found in spreadsheet setup (as strings)
+        self.problems = []
+
         self.odbc_driver = odbc_driver
 
         #Define a fill colours  for the spreadsheet(colours alpha,r,g,b)
@@ -89,10 +203,16 @@ class SpreadsheetRun:
         #Give up if fails
         except Exception as err:
             self.response = filename + " - Failed to read: " + err.__doc__
+            self.problems.append(self.response)
             return
+
+        #Cell styles used when writing results, created once per workbook
+        self.styles = StyleRegistry(self.wb, self.fill_colours, self.cell_thin_border)
+
         #Give up if run tab not present
         if "Run" not in self.wb.sheetnames:
             print("Can't proceed as no 'Run' tab in spreadsheet.", filename)
+            self.problems.append("No 'Run' tab in spreadsheet.")
             return
 
         # Read details of tabs to be included in run
@@ -117,10 +237,19 @@ class SpreadsheetRun:
                     print("Tab", tab, "added to test run.")
                 else:
                     print("Tab", tab, "not included because it is not present in", filename)
+                    self.problems.append("Run tab lists " + tab + " but there is no such tab.")
 
         #Dictionary to hold number of errors found for each tab
         self.tab_error_counts = {k:0 for k in tabs_in_run}
 
+        #Named groups of databases (from optional Databases tab)
+        self.database_groups = self.read_database_groups()
+
+        #Only checking the spreadsheet - stop before anything is run
+        if validate_only:
+            self.validate(tabs_in_run)
+            return
+
         #Dictionary which will hold the key column positions for each tab in run
         self.tab_cols = {k:"" for k in tabs_in_run}
 
@@ -130,6 +259,14 @@ class SpreadsheetRun:
         #Records which tabs have tabulated results
         self.tabulated_results = []
 
+        #Single thread writes results of finished checks to spreadsheet
+        writer = threading.Thread(target=self.writer_loop)
+        writer.start()
+        #Fixed number of worker threads, if set
+        for _ in range(self.max_workers):
+            worker = threading.Thread(target=self.worker_loop)
+            worker.start()
+
         # Process each tab in tab list (index number, ti, used to set results column in summary tab)
         # tab off-set value for summary results columns - shifts to right.
         # Minimum tof is 1 because column numbers start from 1 but ti starts from 0
@@ -137,20 +274,30 @@ class SpreadsheetRun:
         for ti, tab in enumerate(tabs_in_run):
             print("Processing tab", tab)
             # Add tab name to title row in summary tab
+            self.styles.format(self.summary_tab.cell(row=self.heading_row, column=ti+tof),
+                               bold=True, border=True, fill=2)
             self.summary_tab.cell(row=self.heading_row, column=ti+tof).value = tab
-            self.summary_tab.cell(row=self.heading_row, column=ti+tof).border = self.cell_thin_border
-            self.summary_tab.cell(row=self.heading_row, column=ti+tof).font = openpyxl.styles.Font(bold=True)
-            self.summary_tab.cell(row=self.heading_row, column=ti+tof).fill = self.fill_colours[2]
             #Process queries in tab
             self.process_tab(tab, summary_col=ti+tof)
 
+        #Tell workers there are no more checks
+        for _ in range(self.max_workers):
+            self.queue.put(None)
+
         #Ensures items below will run only after all items in queue have been processed
         self.queue.join()
+        self.write_queue.join()
+        self.write_queue.put(None)
+        writer.join()
 
         #Save the changes
         self.save(filename)
         print("*Finished " + filename + "*")
 
+        if self.metrics:
+            self.metrics.record_workbook(filename, time.time() - run_start,
+                                         self.tab_error_counts)
+
 
     def set_summary_tab(self):
         """Set summary tab in spreadsheet"""
@@ -164,22 +311,58 @@ class SpreadsheetRun:
         self.summary_tab.sheet_view.showGridLines = False
         #Add some details to summary tab
         self.summary_tab["A1"].value = "Summary of Database Connection Test Results"
-        self.summary_tab["A1"].font = openpyxl.styles.Font(bold=True)
+        self.styles.format(self.summary_tab["A1"], bold=True)
         self.summary_tab["A2"].value = time.strftime("Run start: %d-%b-%Y %H:%M:%S")
-        #Add host name and IP address to summary
-        hostname = socket.gethostname()
-        ipaddr = socket.gethostbyname(hostname)
-        self.summary_tab["A3"].value = "Run from: " + hostname + " - " + ipaddr
+        #Add host name to summary (IP address added by self.save() as
+        #lookup runs in background during the checks)
+        self.summary_tab["A3"].value = "Run from: " + host_lookup().hostname
         #Add name of script that created it
         self.summary_tab["A4"].value = "Created by: " + own_name() #os.path.basename(sys.argv[0])
 
 
-    def process_tab(self, tab_name, summary_col):
+    def read_database_groups(self):
+        """Read named groups of databases from optional "Databases" tab.
+        Group name in column A and its databases in the following columns,
+        starting from row below self.heading_row.
+        Returns:
+            dictionary of group name: list of database names
         """
-        Run tests in specified tab
+        groups = {}
+        if "Databases" not in self.wb.sheetnames:
+            return groups
+        ws = self.wb["Databases"]
+        for cells in ws.iter_rows(min_row=self.heading_row+1, values_only=True):
+            if cells and cells[0] is not None:
+                name = str(cells[0]).strip()
+                groups[name] = [str(c).strip() for c in cells[1:] if c is not None and str(c).strip()]
+        return groups
+
+    def expand_databases(self, database):
+        """Returns list of databases to run against for a Database cell value.
+        Value can be a group name from the Databases tab, several database
+        names separated by DATABASE_SEPARATOR, or a single database name.
+        """
+        if database in self.database_groups:
+            return self.database_groups[database]
+        if DATABASE_SEPARATOR in database:
+            return [d.strip() for d in database.split(DATABASE_SEPARATOR) if d.strip()]
+        return [database]
+
+    def read_tab(self, tab_name):
+        """
+        Read details of checks in specified tab without running them and
+        find problems that would stop checks running properly.
         Args:
-            tab_name (str) - name of tab to be processed (must be present)
-            summary_col (int) - column number on summary tab where results will be writen
+            tab_name (str) - name of tab to be read (must be present)
+        Returns:
+            dictionary with keys:
+                datacols - column numbers of headings (-1 when not found)
+                missing_cols - list of missing mandatory columns
+                start_row, end_row - range of rows read (None if C3/C4 invalid)
+                checks - list of params dictionaries, one per row to be run.
+                         "databases" key holds list of databases to run against.
+                skipped - list of skipped row numbers
+                problems - list of problem descriptions
         """
         #Select the tab
         ws = self.wb[tab_name]
@@ -195,97 +378,286 @@ class SpreadsheetRun:
                             "Result Row":"result_row",
                             "Local Condition":"condition",
                             "Result Condition":"r_condition",
-                            "Heading":"heading"
+                            "Heading":"heading",
+                            "Aggregate":"aggregate"
                            }
 
         #Find column positions of expected column headings in supplied tab
         headnames = ["Database", "Username", "Password", "Result", "Date/Time",
                      "Skip", "SQL", "Result Tab", "Result Column",
                      "Result Row", "Result Condition", "Local Condition",
-                     "Heading"]
+                     "Heading", "Aggregate"]
         datacols = dict.fromkeys(headnames, -1)
         for col in range(1, 21):
             value = str(ws.cell(row=self.heading_row, column=col).value)
             if value in datacols:
                 datacols[value] = col
 
+        tab_spec = {"datacols":datacols,
+                    "missing_cols":[],
+                    "start_row":None,
+                    "end_row":None,
+                    "checks":[],
+                    "skipped":[],
+                    "problems":[]
+                   }
+        problems = tab_spec["problems"]
+
         #See if mandatory required columns found. Record missing columns in bad
-        missing_cols = []
+        missing_cols = tab_spec["missing_cols"]
         for key in ["Database", "Username", "Password", "Result", "Date/Time", "Skip"]:
             if datacols[key] == -1:
-                print("Column", key, "not found in tab", tab_name)
+                problems.append("Column " + key + " not found.")
                 missing_cols.append(key)
 
-        #Store datacols for this present tab
-        self.tab_cols[tab_name] = datacols
-
         #Read start and end row values
-        self.start_row = ws["C3"].value
-        self.end_row = ws["C4"].value
+        start_row = whole_number(ws["C3"].value)
+        end_row = whole_number(ws["C4"].value)
+        if start_row is None or end_row is None:
+            problems.append("Start row (C3) and end row (C4) must be whole numbers."
+                            " Found {!r} and {!r}.".format(ws["C3"].value, ws["C4"].value))
+            return tab_spec
         # Ensure start row is below the heading row
-        if self.start_row <= self.heading_row:
-            self.start_row = self.heading_row + 1
+        if start_row <= self.heading_row:
+            start_row = self.heading_row + 1
         # Warn if end row is less than start row - could add reverse order later
-        if self.end_row < self.start_row:
-            print("End row ({}) is less than start row ({}).".format(self.end_row, self.start_row))
-
-        #For each row in chosen range, extract key details from spreadsheet,
-        #, run query and update spreadsheet with outcome.
+        if end_row < start_row:
+            problems.append("End row ({}) is less than start row ({}).".format(end_row, start_row))
+        tab_spec["start_row"] = start_row
+        tab_spec["end_row"] = end_row
 
         #Loop over each row in chosen range
-        for row in range(self.start_row, self.end_row+1):
+        for row in range(start_row, end_row+1):
 
             #Only run if (a) Skip is not set & (b) required columns found
+            if missing_cols:
+                tab_spec["skipped"].append(row)
+                continue
             skip = ws.cell(row=row, column=datacols["Skip"]).value
             skip = str(skip).lower()[:1]
-            if skip != "y" and not missing_cols:
-
-                #Params for check (not from each row). More added in loop below.
-                params = {"row":row,
-                          "tab_name":tab_name,
-                          "summary_col":summary_col,
-                         }
-
-                #Read row-based param values for present row (sql, username, password ..)
-                for column in headings_to_keys:
-                    #Can only read if column actually present
-                    if datacols[column] != -1:
-                        value = ws.cell(row=row, column=datacols[column]).value
-                        if value is None:
-                            value = ""
-                        param_key = headings_to_keys[column]
-                        params[param_key] = str(value)
-
-                #Remove any carriage returns from r_condition and replace with spaces
-                if "r_condition" in params:
-                    params["r_condition"] = params["r_condition"].replace("\n", " ").replace("\r", " ")
-
-                # Missing password handling
-                # Note set once for all rows with missing passwords in a run
-                if not params.get("password", ""):
-                    if not self.global_password:
-                        self.global_password = getpass.getpass("Database password: ")
-                    params["password"] = self.global_password
+            if skip == "y":
+                tab_spec["skipped"].append(row)
+                continue
+
+            #Params for check (not from each row). More added in loop below.
+            params = {"row":row,
+                      "tab_name":tab_name,
+                     }
+
+            #Read row-based param values for present row (sql, username, password ..)
+            for column in headings_to_keys:
+                #Can only read if column actually present
+                if datacols[column] != -1:
+                    value = ws.cell(row=row, column=datacols[column]).value
+                    if value is None:
+                        value = ""
+                    param_key = headings_to_keys[column]
+                    params[param_key] = str(value)
+
+            #Remove any carriage returns from r_condition and replace with spaces
+            if "r_condition" in params:
+                params["r_condition"] = params["r_condition"].replace("\n", " ").replace("\r", " ")
+
+            #Database cell can name a group of databases
+            params["databases"] = self.expand_databases(params.get("database", ""))
+
+            for problem in self.check_problems(params):
+                problems.append("Row {}: {}".format(row, problem))
+            tab_spec["checks"].append(params)
+
+        return tab_spec
+
+    def check_problems(self, params):
+        """Find problems in the details of a single check
+        Args:
+            params (dict) - check details as read by self.read_tab()
+        Returns:
+            list of problem descriptions (empty if none found)
+        """
+        problems = []
+        for key, name in [("username", "Username"), ("database", "Database"), ("sql", "SQL")]:
+            if key in params and not params[key]:
+                problems.append(name + " is blank.")
+        for key, name in [("condition", "Local Condition"), ("r_condition", "Result Condition")]:
+            if params.get(key):
+                try:
+                    compile(params[key], name, "eval")
+                except SyntaxError as err:
+                    problems.append("{} {!r} is not a valid expression ({}).".format(name, params[key], err.msg))
+        if params.get("database") and not params["databases"]:
+            problems.append("Database group {!r} has no databases.".format(params["database"]))
+        if params.get("result_tab") and not params.get("result_col"):
+            problems.append("Result Tab set but Result Column is blank.")
+        problems.extend(self.result_location_problems(params))
+        if use_aggregate(params):
+            try:
+                # Only structure matters, not actual column names
+                condition_to_sql(params["r_condition"], ["COLUMN"])
+            except ValueError:
+                problems.append("Result Condition {!r} can't be run as an aggregate"
+                                " (all rows will be fetched).".format(params["r_condition"]))
+        elif str(params.get("aggregate", "")).lower()[:1] == "y":
+            problems.append("Aggregate needs a Result Condition and no Local Condition.")
+        return problems
+
+    def result_location_problems(self, params):
+        """Find problems with Result Column/Result Row that would stop the
+        results table being written
+        Args:
+            params (dict) - check details as read by self.read_tab()
+        Returns:
+            list of problem descriptions (empty if none found)
+        """
+        problems = []
+        if params.get("result_col"):
+            try:
+                column_index_from_string(params["result_col"])
+            except ValueError:
+                problems.append("Result Column {!r} is not a column letter.".format(params["result_col"]))
+        if params.get("result_row") and whole_number(params["result_row"]) is None:
+            problems.append("Result Row {!r} is not a whole number.".format(params["result_row"]))
+        return problems
+
+    def write_problem(self, params, message):
+        """Pass check that can't be run straight to writer thread, so its
+        row gets an error result (red) without running the query and
+        without a results table.
+        Args:
+            params (dict) - check details
+            message (str) - error message for Result cell
+        """
+        dbcheck = DbCon(str(params.get("username") or ""), "",
+                        str(params.get("database") or ""), do_nothing=True)
+        dbcheck.errors.append(message)
+        self.write_queue.put((dict(params, result_tab=""), dbcheck))
+
+    def process_tab(self, tab_name, summary_col):
+        """
+        Run tests in specified tab
+        Args:
+            tab_name (str) - name of tab to be processed (must be present)
+            summary_col (int) - column number on summary tab where results will be writen
+        """
+        tab_spec = self.read_tab(tab_name)
+        for problem in tab_spec["problems"]:
+            print("Tab", tab_name + ":", problem)
+
+        #Store datacols for this present tab
+        datacols = tab_spec["datacols"]
+        self.tab_cols[tab_name] = datacols
+        missing_cols = tab_spec["missing_cols"]
+
+        #Can't go any further without the row range
+        if tab_spec["start_row"] is None:
+            return
+        self.start_row = tab_spec["start_row"]
+        self.end_row = tab_spec["end_row"]
+
+        #For each check in chosen range, run query and update spreadsheet with outcome.
+        for params in tab_spec["checks"]:
+            params["summary_col"] = summary_col
+
+            # Missing password handling
+            # Note set once for all rows with missing passwords in a run
+            if not params.get("password", ""):
+                if not self.global_password:
+                    self.global_password = getpass.getpass("Database password: ")
+                params["password"] = self.global_password
+
+            #Row naming a group of databases is run against each of them
+            # in parallel, with results collected by a FanOut object
+            databases = params.pop("databases")
+            #Nothing to run for an empty group, so go straight to writer
+            # with error result
+            if not databases:
+                self.write_problem(params, "No databases in group {!r}.".format(params.get("database", "")))
+                continue
+            #Results table couldn't be written, so don't run the check
+            location_problems = self.result_location_problems(params)
+            if location_problems:
+                self.write_problem(params, "Not run. " + " ".join(location_problems))
+                continue
+            if databases == [params.get("database", "")]:
+                fan_out_params = [params]
+            else:
+                fan_out = FanOut(params["database"], len(databases))
+                fan_out_params = [dict(params, database=database, fan_out=fan_out,
+                                       fan_out_index=di)
+                                  for di, database in enumerate(databases)]
 
+            for params in fan_out_params:
                 #Add params to queue for multi-thread processing
                 self.queue.put(params)
+                if self.metrics:
+                    self.metrics.set_queue_depth(self.queue.qsize())
 
                 #Create thread to carry out the check - uses self.thread_action()
-                thread = threading.Thread(target=self.thread_action)
-                thread.start()
+                if not self.max_workers:
+                    thread = threading.Thread(target=self.thread_action)
+                    thread.start()
 
-            #Skipped Row - still add note about skipping to summary page
+        #Skipped Row - still add note about skipping to summary page
+        ws = self.wb[tab_name]
+        for row in tab_spec["skipped"]:
+            summary_cell = self.summary_tab.cell(row=row, column=summary_col)
+            self.styles.format(summary_cell, border=True)#Cell border
+            if missing_cols:
+                summary_cell.value = "Skipped. Warning missing column(s): " + ",".join(missing_cols)
             else:
-                summary_cell = self.summary_tab.cell(row=row, column=summary_col)
-                summary_cell.border = self.cell_thin_border#Cell border
-                if missing_cols:
-                    summary_cell.value = "Skipped. Warning missing column(s): " + ",".join(missing_cols)
-                else:
-                    summary_cell.value = "Skipped."
-                    #Only printed if columns not missing, so sure database and username can be read
-                    database = ws.cell(row=row, column=datacols["Database"]).value
-                    username = ws.cell(row=row, column=datacols["Username"]).value
-                    print(username, database, "SKIPPED")
+                summary_cell.value = "Skipped."
+                #Only printed if columns not missing, so sure database and username can be read
+                database = ws.cell(row=row, column=datacols["Database"]).value
+                username = ws.cell(row=row, column=datacols["Username"]).value
+                print(username, database, "SKIPPED")
+
+    def validate(self, tabs_in_run):
+        """Read every tab in run and report problems with the spreadsheet
+        setup, the connections needed for each database and how they will be
+        run. Nothing is run against the databases.
+        Results held in self.problems and self.tab_error_counts (number of
+        problems for each tab).
+        Args:
+            tabs_in_run - list of tab names included in run
+        """
+        #Number of checks against each database
+        connections = {}
+        for tab in tabs_in_run:
+            tab_spec = self.read_tab(tab)
+            self.tab_error_counts[tab] = len(tab_spec["problems"])
+            self.problems.extend(tab + ": " + problem for problem in tab_spec["problems"])
+            for params in tab_spec["checks"]:
+                for database in params["databases"]:
+                    connections[database] = connections.get(database, 0) + 1
+            print("Tab", tab, "-", len(tab_spec["checks"]), "check(s),",
+                  len(tab_spec["skipped"]), "skipped")
+
+        print("\nProblems found:" if self.problems else "\nNo problems found.")
+        for problem in self.problems:
+            print("  " + problem)
+
+        print("\nConnections per database:")
+        for database, count in sorted(connections.items()):
+            print("  {}: {}".format(database or "<No Name!>", count))
+        checks = sum(connections.values())
+        most = max(connections.values() or [0])
+        if self.max_workers:
+            print("\nConcurrency plan: {} check(s) run by {} worker thread(s), so up to {}"
+                  " connection(s) open at once (up to {} to a single database).".format(
+                      checks, self.max_workers, min(checks, self.max_workers),
+                      min(most, self.max_workers)))
+        else:
+            print("\nConcurrency plan: {} check(s), each run in its own thread as its row"
+                  " is read, so up to {} connection(s) open at once"
+                  " (up to {} to a single database).".format(checks, checks, most))
+        if self.concurrency_limits:
+            print("Adaptive limit: each database starts at {} check(s) at once, rising"
+                  " while latency stays flat, up to {} (so up to {} to a single"
+                  " database).".format(self.concurrency_limits.initial,
+                                       self.concurrency_limits.maximum,
+                                       min(most, self.concurrency_limits.maximum,
+                                           self.max_workers or most)))
+        self.response = "{} - validated, {} problem(s) found".format(self.filename,
+                                                                   len(self.problems))
 
     def thread_action(self):
         """Method assigned to each database check thread.
@@ -293,16 +665,125 @@ class SpreadsheetRun:
         """
         # Get parameters from queue
         params = self.queue.get()
+        self.run_check(params)
+
+    def worker_loop(self):
+        """Method assigned to each of the fixed number of worker threads.
+        Runs checks from queue until None received.
+        When adaptive concurrency limits are used, a check against a database
+        already at its limit is put aside in self.deferred and the worker moves
+        on to the next check, so one slow database doesn't hold up the workers.
+        Checks put aside are run as soon as their database has room, and any
+        left when None received are run before the worker finishes.
+        """
+        finished = False
+        while True:
+            params, token = self.take_deferred(wait=finished)
+            if params is None:
+                if finished:
+                    return
+                try:
+                    # Timeout so checks put aside are retried while queue is empty
+                    params = self.queue.get(timeout=DEFERRED_RETRY if self.concurrency_limits else None)
+                except queue.Empty:
+                    continue
+                if params is None:
+                    self.queue.task_done()
+                    finished = True
+                    continue
+                limit = self.check_limit(params)
+                if limit:
+                    token = limit.try_acquire()
+                    if token is None:
+                        with self.deferred_lock:
+                            self.deferred.append(params)
+                        continue
+            self.run_check(params, token)
+
+    def check_limit(self, params):
+        """Returns adaptive_limit.AdaptiveLimit for database of check, or
+        None if not limited (no limits in use or check won't connect)"""
+        if (self.concurrency_limits and params.get("username")
+                and params.get("password") and params.get("database")):
+            return self.concurrency_limits.get(params["database"])
+        return None
+
+    def take_deferred(self, wait=False):
+        """Take a check put aside by self.worker_loop() whose database now
+        has room to run it.
+        Args:
+            wait (bool) - when no database has room, take the first check
+                          anyway (it then waits for its database in run_query)
+        Returns:
+            params and token from AdaptiveLimit.try_acquire() (None if
+            check still needs to acquire), or None, None if nothing to run
+        """
+        with self.deferred_lock:
+            for di, params in enumerate(self.deferred):
+                token = self.check_limit(params).try_acquire()
+                if token is not None:
+                    del self.deferred[di]
+                    return params, token
+            if wait and self.deferred:
+                return self.deferred.pop(0), None
+        return None, None
+
+    def run_check(self, params, token=None):
+        """Run query for a check taken from queue and pass the result to the
+        writer thread. Waits if writer queue is full.
+        Args:
+            params (dict) - check details, see self.perform_check()
+            token - (optional) token when adaptive limit for database already
+                    acquired (see self.worker_loop())
+        """
+        if self.metrics:
+            self.metrics.set_queue_depth(self.queue.qsize())
+            self.metrics.worker_started()
         # Peform the check
-        self.perform_check(**params)
-        # Mark task as done
-        self.queue.task_done()
+        try:
+            r_condition = params.get("r_condition", "") if use_aggregate(params) else ""
+            try:
+                dbcheck = self.run_query(params["username"], params["password"],
+                                         params["database"], params.get("sql", DEFAULT_SQL),
+                                         r_condition=r_condition, token=token)
+            #Any other failure still reported on the row (in red), so the
+            #worker keeps going and every check reaches the writer
+            except Exception as err:
+                traceback.print_exc()
+                dbcheck = DbCon(str(params.get("username") or ""), "",
+                                str(params.get("database") or ""), do_nothing=True)
+                dbcheck.errors.append("Check failed: {}: {}".format(type(err).__name__, err))
+            self.write_queue.put((params, dbcheck))
+        # Mark task as done (even if check failed, so queue.join() still returns)
+        finally:
+            self.queue.task_done()
+            if self.metrics:
+                self.metrics.worker_finished()
+
+    def writer_loop(self):
+        """Method assigned to writer thread. Writes finished checks to
+        spreadsheet until None received.
+        """
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                self.write_queue.task_done()
+                return
+            params, dbcheck = item
+            try:
+                self.perform_check(dbcheck, **params)
+            #Report problem but keep writing other results
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.write_queue.task_done()
 
     def perform_check(self,
+                      dbcheck,
                       username,
                       password,
                       database,
-                      sql="SELECT SYSDATE FROM DUAL",
+                      sql=DEFAULT_SQL,
                       row=None,
                       tab_name=None,
                       summary_col=1,
@@ -311,10 +792,14 @@ class SpreadsheetRun:
                       result_col="",
                       result_row="",
                       r_condition="",
-                      heading=""):
-        """Create database connection using specified username, database
-        and password. If successful, run SQL. Writes results to spreadsheet.
+                      heading="",
+                      aggregate="",
+                      fan_out=None,
+                      fan_out_index=0):
+        """Writes results of check to spreadsheet. Called by writer thread
+        once the query has been run by self.run_check().
         Args:
+            dbcheck - DbCon object with already fetched results
             username - username for database
             password - password for database
             database - database name
@@ -328,28 +813,240 @@ class SpreadsheetRun:
             result_row - optional row number of writing results
             r_condition (str) - optional condition applied to data in results table
             heading (str) - optional heading for the query
+            aggregate (str) - optional. When starts with "y", r_condition
+                      was first checked by a server-side aggregate query (see
+                      self.run_aggregate()) and all rows only fetched if some
+                      broke it.
+            fan_out - optional FanOut object when check is one of a group of
+                      databases run from the same row. Results are written when
+                      last database in the group finishes.
+            fan_out_index (int) - position of database within fan_out group
+        """
+        # Results from every database in a group are written together
+        if fan_out:
+            dbchecks = fan_out.add(fan_out_index, dbcheck)
+            if not dbchecks:
+                return
+            database = fan_out.name
+        else:
+            dbchecks = [dbcheck]
+
+        #Results freed once written, or if writing fails part way through
+        try:
+            #Select the worksheet from tab_name
+            ws = self.wb[tab_name]
+            #Get the colum positions for the tab
+            datacols = self.tab_cols[tab_name]
+
+            #Write date/time to spreadsheet
+            ws.cell(row=row, column=datacols["Date/Time"]).value = datetime.datetime.now()
+
+            #Write result to spreadsheet
+            resultcell = ws.cell(row=row, column=datacols["Result"])
+
+            #Assess result from each database. Cell colour is the worst of them.
+            values = []
+            c_index = 1 #green background
+            for dbcheck in dbchecks:
+                value, db_c_index = self.assess_result(dbcheck, username, condition)
+                values.append(value)
+                if COLOUR_SEVERITY.index(db_c_index) < COLOUR_SEVERITY.index(c_index):
+                    c_index = db_c_index
+
+                #Record outcome and database latencies in metrics
+                if self.metrics:
+                    self.metrics.record_check(self.filename, tab_name, row, dbcheck.database,
+                                              username, CHECK_OUTCOMES[db_c_index])
+                    self.metrics.observe_latency(dbcheck.database, "connect", dbcheck.connect_time)
+                    self.metrics.observe_latency(dbcheck.database, "query", dbcheck.query_time)
+
+                if dbcheck.profile:
+                    self.write_slow_query(dbcheck, tab_name, row, username, heading)
+
+            #Group results listed one database per line
+            if fan_out:
+                value = "\n".join(["{}: {}".format(d.database, v) for d, v in zip(dbchecks, values)])
+            else:
+                value = values[0]
+
+            #Exception handling for situation when error message or result
+            # contains characters that are illegal in spreadsheet.
+            try:
+                resultcell.value = value
+            except IllegalCharacterError as err:
+                temp = "Filtered Message: " + "".join([c for c in str(value)
+                                                       if 31 < ord(c) < 127])
+                resultcell.value = temp
+            ## Hasty exception handling to help investigate UnicodeDecode errors
+            # could have UnicodeDecodeError instead of general Exception
+            except Exception as err:
+                print("*********************************")
+                print(err)
+                print("T:\n", type(value))
+                print("R:\n", value)
+                print("*********************************")
+                _ = input("Pause to look at error!")
+
+            #Change results cell background colour to index value set in checks above
+            resultcell.fill = self.fill_colours[c_index]
+
+            #Update error count if we have a non-green (error) result
+            if tab_name:
+                if c_index != 1:
+                    self.tab_error_counts[tab_name] += 1
+
+            # Update summary tab with summary result - database name with green
+            # backround for OK, red for error
+            summary_cell = self.summary_tab.cell(row=row, column=summary_col)
+            #Cell border and background colour
+            self.styles.format(summary_cell, border=True, fill=c_index)
+            if database:
+                summary_cell.value = database+" - "+ username +" - " + sql#Write database name
+            else:
+                summary_cell.value = "<No Name!>"
+
+            #Write results to specified tab and column if values setied
+            if result_tab and result_col:
+                #Default result_row to self.heading_row
+                #Also ensure it's an integer
+                if not result_row:
+                    result_row = self.heading_row
+                else:
+                    result_row = int(result_row)
+                #Group results placed side by side, one table per database,
+                #spaced by width of widest table plus a gap column
+                column = column_index_from_string(result_col)
+                table_width = max([len(d.headings) for d in dbchecks] + [1]) + 1
+                for di, dbcheck in enumerate(dbchecks):
+                    #Condition doesn't apply to aggregate counts
+                    self.write_results_table(dbcheck=dbcheck,
+                                             tab=result_tab,
+                                             col_letter=get_column_letter(column + di*table_width),
+                                             result_row=result_row,
+                                             r_condition="" if dbcheck.aggregated else r_condition,
+                                             heading=heading)
+
+                self.tabulated_results.append(result_tab+" ("+result_col+")")
+        finally:
+            #Free memory/disk space used by results of every database in group
+            for dbcheck in dbchecks:
+                dbcheck.clear_results()
+
+    def run_query(self, username, password, database, sql, r_condition="", token=None):
+        """Run SQL against a single database (see self.perform_check())
+        Args:
+            username, password, database, sql - as self.perform_check()
+            r_condition (str) - optional Result Condition to check with a
+                                server-side aggregate before fetching rows
+            token - optional token when adaptive limit for database already
+                    acquired, otherwise waits for database to have room
+        Returns:
+            DbCon object holding results/errors
         """
         # Execute the query using DbCon object if we have
         # username/password/database and row not skipped
         if username and password and database:
-            # Set odbc driver if one database doesn't start with "!"
-            if database.startswith("!"):
-                odbc_driver = ""
-            else:
-                odbc_driver = self.odbc_driver
-            dbcheck = DbCon(username, password, database, odbc_driver=odbc_driver)
-            dbcheck.runsql(sql)
-            dbcheck.close()
+            #Wait until database can take another check
+            if self.concurrency_limits:
+                limit = self.concurrency_limits.get(database)
+                if token is None:
+                    token = limit.acquire()
+            dbcheck = None
+            try:
+                # Set odbc driver if one database doesn't start with "!"
+                if database.startswith("!"):
+                    odbc_driver = ""
+                else:
+                    odbc_driver = self.odbc_driver
+                dbcheck = DbCon(username, password, database, odbc_driver=odbc_driver,
+                                memory_budget=self.memory_budget)
+                #Statistics of a slow query are for its own execution
+                dbcheck.snapshot_stats = self.slow_query_time is not None
+                #Only fetch all rows if aggregate not possible or shows rows break condition
+                if not (r_condition and self.run_aggregate(dbcheck, sql, r_condition)):
+                    dbcheck.runsql(sql)
+                #Profile slow query before anything else run on connection
+                if (self.slow_query_time is not None and dbcheck.query_time is not None
+                        and dbcheck.query_time >= self.slow_query_time):
+                    dbcheck.profile = dbcheck.profile_last_query()
+                dbcheck.close()
+            finally:
+                if self.concurrency_limits and dbcheck is None:
+                    limit.release(token, errors=["Check failed"])
+                elif self.concurrency_limits:
+                    #Times of failed checks (e.g. connect timeouts) aren't
+                    #latencies. Query latencies only comparable for the same
+                    #SQL actually run (aggregate query keyed separately)
+                    latencies = []
+                    if not dbcheck.errors:
+                        if dbcheck.cnxn:
+                            latencies.append(("connect", "", dbcheck.connect_time))
+                        latencies.append(("query", dbcheck.sql, dbcheck.query_time))
+                    limit.release(token, latencies, dbcheck.errors)
+                    if self.metrics:
+                        self.metrics.set_concurrency_limit(database, int(limit.limit))
         else:
             dbcheck = DbCon(username, password, database, do_nothing=True)
             dbcheck.errors.append("Not run because username or password or database value is blank.")
+        return dbcheck
 
+    def run_aggregate(self, dbcheck, sql, r_condition):
+        """Count rows breaking Result Condition on the database server, by
+        wrapping the SQL in a COUNT/SUM(CASE ...) query, instead of fetching
+        every row. Only simple conditions can be translated to SQL (see
+        condition_sql.py).
+        Args:
+            dbcheck - DbCon object with open connection
+            sql (str) - query
+            r_condition (str) - Result Condition
+        Returns:
+            True if no rows break the condition (dbcheck results then hold
+            the TOTAL_ROWS, FLAGGED_ROWS counts), False if all rows need
+            fetching because some do or the aggregate couldn't be run.
+        """
+        if not dbcheck.cnxn:
+            return False
+        #Find column names without fetching any rows
+        rows, headings, errors = dbcheck.execute(describe_sql(sql))
+        if errors:
+            return False
+        try:
+            predicate = condition_to_sql(r_condition, headings, dbcheck.column_kinds)
+        except ValueError:
+            print("Result Condition", r_condition, "can't be run as an aggregate")
+            return False
+        dbcheck.runsql(aggregate_sql(sql, predicate))
+        if dbcheck.errors or dbcheck.results[0][1]:
+            dbcheck.errors = []
+            return False
+        dbcheck.aggregated = True
+        return True
+
+    def assess_result(self, dbcheck, username, condition=""):
+        """Format query result for writing to a single cell and work out its
+        colour using the optional local condition.
+        Args:
+            dbcheck - DbCon object with already fetched results
+            username (str) - database username (used in messages)
+            condition (str) - optional condition used to determine pass/fail value
+        Returns:
+            value for result cell (results or error messages)
+            fill colour index
+        """
         #Fromat errors for writing to spreadsheet
         error_string = ", ".join(dbcheck.errors)
 
+        #Error result
+        if dbcheck.errors:
+            print(dbcheck.database, username, ":", error_string)
+            return error_string, 0 # Red background
+
         #Format query results for writing to single cell in spreadsheet.
+        #Aggregate counts shown with their names
+        if dbcheck.aggregated:
+            result = ", ".join(["{}: {}".format(h, v) for h, v in zip(dbcheck.headings, dbcheck.results[0])])
         #If results a single value just keep it.
-        if len(dbcheck.results) == 1:
+        elif len(dbcheck.results) == 1:
             if len(dbcheck.results[0]) == 1:
                 result = dbcheck.results[0][0]
             #Concatenate results for single row response with more than one column
@@ -368,98 +1065,68 @@ class SpreadsheetRun:
                 temp = ",".join([str(c) for c in r])
                 result = result + temp
 
-        #Select the worksheet from tab_name
-        ws = self.wb[tab_name]
-        #Get the colum positions for the tab
-        datacols = self.tab_cols[tab_name]
-
-        #Write date/time to spreadsheet
-        ws.cell(row=row, column=datacols["Date/Time"]).value = datetime.datetime.now()
-
-        #Write result to spreadsheet
-        resultcell = ws.cell(row=row, column=datacols["Result"])
-
         #Default colour index for result cell
         c_index = 1 #green background
 
-        #Error result
-        if dbcheck.errors:
-            print(database, username, ":", error_string)
-            #Details for query set tab. Exception handling for situation when
-            # error message contains characters that are illegal in spreadsheet.
-            try:
-                resultcell.value = error_string # Write error messages
-            except IllegalCharacterError as err:
-                temp = "Filtered Message: " + "".join([c for c in error_string
-                                                       if 31 < ord(c) < 127])
-                resultcell.value = temp
-
-            c_index = 0# Red background
-
-        #Non-error result
-        else:
-            ##print(database,username,":",result)
-            ## Hasty exception handling to help investigate UnicodeDecode errors
+        #If there's a supplied condition, check it and change background colour index based on result
+        if condition:
             try:
-                resultcell.value = result #unicode(result).encode('utf8') # Write results of query
-            # could have UnicodeDecodeError instead of general Exception
+                x = result # x created for convenient use in condition
+                check = eval(condition)
+                #Set background to orange when check fails (otherwise leave at previous value)
+                if not check:
+                    c_index = 4
+            #Set background to purple if exception raised by check
             except Exception as err:
-                print("*********************************")
-                print(err)
-                print("T:\n", type(result))
-                print("R:\n", result)
-                print("*********************************")
-                _ = input("Pause to look at error!")
-
-            #If there's a supplied condition, check it and change background colour index based on result
-            if condition:
-                try:
-                    x = result # x created for convenient use in condition
-                    check = eval(condition)
-                    #Set background to orange when check fails (otherwise leave at previous value)
-                    if not check:
-                        c_index = 4
-                #Set background to purple if exception raised by check
-                except Exception as err:
-                    print("Condition", condition, "raised exception with value", result)
-                    c_index = 5
-
-        #Change results cell background colour to index value set in checks above
-        resultcell.fill = self.fill_colours[c_index]
-
-        #Update error count if we have a non-green (error) result
-        if tab_name:
-            if c_index != 1:
-                self.tab_error_counts[tab_name] += 1
-
-        # Update summary tab with summary result - database name with green
-        # backround for OK, red for error
-        summary_cell = self.summary_tab.cell(row=row, column=summary_col)
-        summary_cell.border = self.cell_thin_border#Cell border
-        if database:
-            summary_cell.value = database+" - "+ username +" - " + sql#Write database name
-        else:
-            summary_cell.value = "<No Name!>"
-
-        #Set summary cell background colour
-        summary_cell.fill = self.fill_colours[c_index]#set background colour
-
-        #Write results to specified tab and column if values setied
-        if result_tab and result_col:
-            #Default result_row to self.heading_row
-            #Also ensure it's an integer
-            if not result_row:
-                result_row = self.heading_row
-            else:
-                result_row = int(result_row)
-            self.write_results_table(dbcheck=dbcheck,
-                                     tab=result_tab,
-                                     col_letter=result_col,
-                                     result_row=result_row,
-                                     r_condition=r_condition,
-                                     heading=heading)
-
-            self.tabulated_results.append(result_tab+" ("+result_col+")")
+                print("Condition", condition, "raised exception with value", result)
+                c_index = 5
+        return result, c_index
+
+    def write_slow_query(self, dbcheck, tab_name, row, username, heading):
+        """Add row to Slow Queries tab with the statistics and execution plan
+        of a slow query (tab created if not present). SQL shown is what was
+        actually run and profiled (dbcheck.sql), which in Aggregate mode is
+        the COUNT/SUM query wrapped round the check's SQL.
+        Args:
+            dbcheck - DbCon object with profile from profile_last_query()
+            tab_name (str) - query tab of the check
+            row (int) - row number of the check
+            username (str) - database username
+            heading (str) - heading of the check
+        """
+        if SLOW_QUERIES_TAB not in self.wb.sheetnames:
+            ws = self.wb.create_sheet(title=SLOW_QUERIES_TAB)
+            ws.sheet_view.showGridLines = False
+            ws["A1"].value = "Tab added by script on "+time.strftime("%d-%b-%Y %H:%M:%S")
+            ws["A1"].style = self.styles.style(bold=True)
+            self.styles.apply(ws, self.heading_row, 1, self.heading_row, len(SLOW_QUERY_HEADINGS),
+                              self.styles.style(bold=True, border=True, fill=2))
+            for hc, slow_heading in enumerate(SLOW_QUERY_HEADINGS):
+                ws.cell(row=self.heading_row, column=hc+1).value = slow_heading
+                ws.column_dimensions[get_column_letter(hc+1)].width = (len(slow_heading)+2)*1.25
+            #SQL and plan columns wider
+            for slow_heading in ("SQL Run", "Plan"):
+                column = SLOW_QUERY_HEADINGS.index(slow_heading) + 1
+                ws.column_dimensions[get_column_letter(column)].width = (MAX_COLUMN_WIDTH+2)*1.25
+        ws = self.wb[SLOW_QUERIES_TAB]
+
+        profile = dbcheck.profile
+        values = ([dbcheck.execution_time, tab_name, row, heading, dbcheck.database,
+                   username, round(dbcheck.query_time, 3), profile["sql_id"]]
+                  + [profile["stats"].get(key) for slow_heading, key in SLOW_QUERY_STATS]
+                  + [dbcheck.sql, "\n".join(profile["plan"]), ", ".join(profile["errors"])])
+        new_row = max(ws.max_row + 1, self.heading_row + 1)
+        self.styles.apply(ws, new_row, 1, new_row, len(values), self.styles.style(border=True))
+        for vc, value in enumerate(values):
+            # Plan/errors could contain characters that are illegal in spreadsheet
+            try:
+                ws.cell(row=new_row, column=vc+1).value = value
+            except IllegalCharacterError:
+                ws.cell(row=new_row, column=vc+1).value = "".join([c for c in str(value)
+                                                                    if c == "\n" or 31 < ord(c) < 127])
+        #Keep plan layout readable
+        plan_cell = ws.cell(row=new_row, column=SLOW_QUERY_HEADINGS.index("Plan") + 1)
+        plan_cell.style = self.styles.style(border=True, monospace=True)
 
     def write_results_table(self, dbcheck, tab, col_letter, result_row,
                             r_condition="", heading=""):
@@ -484,11 +1151,12 @@ class SpreadsheetRun:
         #Create tab if it's not already present
         if tab not in self.wb.sheetnames:
             self.wb.create_sheet(title=tab)
+            self.created_tabs.add(tab)
             ws = self.wb[tab]
             #Hide the grid
             ws.sheet_view.showGridLines = False
             ws["A1"].value = "Tab added by script on "+time.strftime("%d-%b-%Y %H:%M:%S")
-            ws["A1"].font = openpyxl.styles.Font(bold=True)
+            ws["A1"].style = self.styles.style(bold=True)
 
         #Select the tab
         ws = self.wb[tab]
@@ -498,25 +1166,24 @@ class SpreadsheetRun:
         #Get column number from letter
         column = column_index_from_string(col_letter)
 
+        #Named styles (quickest) only used in tabs created by the script, as
+        #they also replace number format, alignment etc. that may have been
+        #set up in existing results tabs. There only font, border and fill set.
+        new_tab = tab in self.created_tabs
+
         #Add title
         cell = ws.cell(row=row-1, column=column)
         cell.value = heading+" ("+dbcheck.database+" "+dbcheck.execution_time+")"
-        cell.font = openpyxl.styles.Font(bold=True)
+        self.styles.format(cell, bold=True, named=new_tab)
 
         #Add headings to restuls spreadsheet tab (with condition on end if included)
         headings = dbcheck.headings[:]
-        dc = 0#delta column
         for dc, heading in enumerate(headings):
             cell = ws.cell(row=row, column=column+dc)
+            self.styles.format(cell, bold=True, border=True, fill=2, named=new_tab) # Blue
             cell.value = heading
-            cell.border = self.cell_thin_border
-            cell.font = openpyxl.styles.Font(bold=True)
-            cell.fill = self.fill_colours[2] # Blue
-            #Adjust column width based on width of heading - but only make bigger
-            ##print(openpyxl.cell.get_column_letter(dc+1),len(heading))
-            head_width = (len(heading)+2)*1.25
-            if  ws.column_dimensions[get_column_letter(column+dc)].width < head_width:
-                ws.column_dimensions[get_column_letter(column+dc)].width = head_width
+        #Length of longest value in each column, used to set column widths
+        max_lengths = [len(str(heading)) for heading in headings]
 
         #Write data to spreadsheet
         row = row + 1#shift below the heading row
@@ -534,12 +1201,27 @@ class SpreadsheetRun:
             # Change background colour
             ws.cell(row=row, column=column).fill = self.fill_colours[0]
 
-        #Iterate over query results and write them
-        for dr, rowdata in enumerate(dbcheck.results):
-            for dc, colvalue in enumerate(rowdata):
-                cell = ws.cell(row=row+dr, column=column+dc)
-                cell.value = colvalue
-                cell.border = self.cell_thin_border
+        #Condition compiled once rather than for every cell
+        if r_condition:
+            r_condition = compile(r_condition, "Result Condition", "eval")
+        #Cell styles: plain, orange (condition true), purple (condition exception)
+        data_styles = {None:self.styles.style(border=True),
+                       4:self.styles.style(border=True, fill=4),
+                       5:self.styles.style(border=True, fill=5)}
+
+        #Iterate over query results and write them. Cells for whole table
+        #fetched in one go.
+        width = len(headings)
+        if len(dbcheck.results):
+            width = max(width, len(dbcheck.results[0]))
+        max_lengths.extend([0] * (width - len(max_lengths)))
+        table_cells = []
+        if dbcheck.results and width:
+            table_cells = ws.iter_rows(min_row=row, max_row=row+len(dbcheck.results)-1,
+                                       min_col=column, max_col=column+width-1)
+        for rowdata, rowcells in zip(dbcheck.results, table_cells):
+            for dc, (colvalue, cell) in enumerate(zip(rowdata, rowcells)):
+                fill = None
 
                 #If there's a supplied condition, check it and change
                 # background colour index based on result
@@ -552,12 +1234,28 @@ class SpreadsheetRun:
                         # Set background to orange when check passes
                         # (otherwise leave at previous value)
                         if check:
-                            cell.fill = self.fill_colours[4]#Orange
+                            fill = 4#Orange
                     #Set background to purple if exception raised by check
                     except Exception as err:
-                        cell.fill = self.fill_colours[5]#purple
+                        fill = 5#purple
                         check = "Exception"
 
+                #Style set before value so date values still get date format
+                if new_tab:
+                    cell.style = data_styles[fill]
+                else:
+                    self.styles.format(cell, border=True, fill=fill)
+                cell.value = colvalue
+                if colvalue is not None:
+                    max_lengths[dc] = max(max_lengths[dc], len(str(colvalue)))
+
+        #Adjust column widths to fit headings and data - but only make bigger
+        for dc, length in enumerate(max_lengths):
+            col_width = (min(length, MAX_COLUMN_WIDTH)+2)*1.25
+            dimension = ws.column_dimensions[get_column_letter(column+dc)]
+            if dimension.width is None or dimension.width < col_width:
+                dimension.width = col_width
+
         #Return location of data (left column, top row), (width, height)
         return (column, result_row+1), (len(dbcheck.headings), len(dbcheck.results))
 
@@ -575,59 +1273,323 @@ class SpreadsheetRun:
         #Add details of tabulated results (if we have any) to summary tab
         if self.tabulated_results:
             ws["A4"].value = "Tabulated Results Recorded: " + ", ".join(self.tabulated_results)
+        #Add host name and IP address
+        hostname, ipaddr = host_lookup().details(timeout=HOST_LOOKUP_TIMEOUT)
+        ws["A3"].value = "Run from: " + hostname + " - " + ipaddr
         #Add hyperlinks to left column of summary tab
         ws.cell(row=self.heading_row, column=1).value = "Tab Hyperlinks"
-        ws.cell(row=self.heading_row, column=1).font = openpyxl.styles.Font(bold=True)
+        self.styles.format(ws.cell(row=self.heading_row, column=1), bold=True)
         for ti, tab in enumerate(self.wb.worksheets):
             ws.cell(row=1+ti+self.heading_row, column=1).value = tab.title
             link = "#" + tab.title + "!A1"
             ws.cell(row=1+ti+self.heading_row, column=1).hyperlink = (link)
 
+        #When main spreadsheet updated, workbook is serialised for it and
+        #(in background mode) the same bytes are used to make results copy.
+        save_start = time.time()
+        data = None
+
         #Save changes to main spreadsheet
         if self.update_master == 'y':
+            data = workbook_bytes(self.wb)
             try:
-                self.wb.save(filename)
+                with open(filename, "wb") as master:
+                    master.write(data)
             except IOError as err:
                 print("***Cannot update main spreadsheet***. Is it open?", err)
             else:
                 print("Spreasheet,", filename, "updated.")
 
         #Save results to another results spreadsheet
-        #Change spreadsheet title on Run tab for this version
-        ws = self.wb["Run"]
-        ws["A1"].value = "Test Results Spreadsheet"
-        ws["A1"].font = openpyxl.styles.Font(bold=True)
-
         #Sub folder for results - setup if not present
         results_folder = os.path.join(os.getcwd(), "results")
-        #Make summary tab the active one
-        self.wb.active = 0
         #Create the folder if it doesn't exist
         if not os.path.exists(results_folder):
             os.makedirs(results_folder)
-        #Add coloured fill to top row of each tab to make spreadsheet
-        # more distinctive from original one.
-        fill = openpyxl.styles.PatternFill(start_color='50FFFF00',
-                                           end_color='50888800',
-                                           fill_type='solid')
-        #Also add hyperlink to summary tab to cell A2
-        for ws in self.wb.worksheets:
-            #Add "Return to summary" hyperlink (except on summary tab itself)
-            if ws.title != "Summary":
-                ws.cell(row=2, column=1).hyperlink = ("#Summary!A1")
-                ws.cell(row=2, column=1).value = ("Summary Hyperlink")
-            #Add yellow stripe to top row - used to distinguish results sheets
-            for column in range(1, 21):
-                ws.cell(row=1, column=column).fill = fill
 
         #Save results to results file
         #Create filename from source file filename without the extension but with "results" and date/time added
         result_filename = os.path.splitext(filename)[0] + time.strftime("_results_[%Y.%m.%d_%H.%M.%S].xlsx")
         results_file = os.path.join(results_folder, result_filename)
-        self.wb.save(results_file)
-        print("Results also saved to:", results_file)
+        #Background mode - results copy made from the already serialised
+        #workbook by another process, so the next spreadsheet can start
+        #straight away. Only worthwhile when main spreadsheet was updated,
+        #otherwise serialising here would take as long as saving.
+        if self.background_save and data is not None:
+            self.save_process = multiprocessing.Process(target=write_results_copy,
+                                                        args=(data, results_file))
+            self.save_process.start()
+            self.results_file = results_file
+        else:
+            mark_results_copy(self.wb)
+            self.wb.save(results_file)
+            print("Results also saved to:", results_file)
         self.response = filename + "\nResults saved: " + result_filename
 
+        save_time = time.time() - save_start
+        print("Save time: {:.2f}s".format(save_time))
+        if self.metrics:
+            self.metrics.record_save(filename, save_time)
+
+
+def mark_results_copy(wb):
+    """Make changes that distinguish results copy of spreadsheet from
+    the original: title on Run tab, hyperlink back to summary and yellow
+    stripe along top of each tab, summary tab made active.
+    Args:
+        wb - openpyxl workbook
+    """
+    #Change spreadsheet title on Run tab for this version
+    ws = wb["Run"]
+    ws["A1"].value = "Test Results Spreadsheet"
+    ws["A1"].font = openpyxl.styles.Font(bold=True)
+
+    #Make summary tab the active one
+    wb.active = 0
+    #Add coloured fill to top row of each tab to make spreadsheet
+    # more distinctive from original one.
+    fill = openpyxl.styles.PatternFill(start_color='50FFFF00',
+                                       end_color='50888800',
+                                       fill_type='solid')
+    #Also add hyperlink to summary tab to cell A2
+    for ws in wb.worksheets:
+        #Add "Return to summary" hyperlink (except on summary tab itself)
+        if ws.title != "Summary":
+            ws.cell(row=2, column=1).hyperlink = ("#Summary!A1")
+            ws.cell(row=2, column=1).value = ("Summary Hyperlink")
+        #Add yellow stripe to top row - used to distinguish results sheets
+        for column in range(1, 21):
+            ws.cell(row=1, column=column).fill = fill
+
+
+def workbook_bytes(wb):
+    """Returns workbook serialised as xlsx file contents"""
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def write_results_copy(data, results_file):
+    """Make results copy of spreadsheet from serialised workbook and save it.
+    Run in separate process when saving in background.
+    Args:
+        data (bytes) - xlsx file contents
+        results_file (str) - filename for results copy
+    """
+    load_openpyxl()
+    wb = openpyxl.load_workbook(io.BytesIO(data))
+    mark_results_copy(wb)
+    wb.save(results_file)
+    print("Results also saved to:", results_file)
+
+
+class StyleRegistry(object):
+    def __init__(self, wb, fill_colours, border):
+        """Named cell styles for a workbook, each created once when first
+        needed. Assigning a named style to a cell is much cheaper than
+        setting its font, border and fill separately.
+        Args:
+            wb - openpyxl workbook
+            fill_colours - list of PatternFill objects (SpreadsheetRun.fill_colours)
+            border - Border object used for cell borders
+        """
+        self.wb = wb
+        self.fill_colours = fill_colours
+        self.border = border
+        # (bold, border, fill index, monospace) -> style name
+        self.names = {}
+        self.bold_font = openpyxl.styles.Font(bold=True)
+        self.lock = threading.Lock()
+
+    def style(self, bold=False, border=False, fill=None, monospace=False):
+        """Returns name of style with given formatting, adding it to the
+        workbook if not already present
+        Args:
+            bold (bool) - bold font
+            border (bool) - thin border
+            fill (int) - optional index of fill colour
+            monospace (bool) - fixed width font, text wrapped and aligned
+                               to top (for multi-line text such as plans)
+        """
+        key = (bold, border, fill, monospace)
+        with self.lock:
+            if key not in self.names:
+                name = "Database Check"
+                name += " Bold" if bold else ""
+                name += " Border" if border else ""
+                name += " Fill {}".format(fill) if fill is not None else ""
+                name += " Monospace" if monospace else ""
+                if name not in self.wb.named_styles:
+                    named_style = openpyxl.styles.NamedStyle(name=name)
+                    if bold:
+                        named_style.font = openpyxl.styles.Font(bold=True)
+                    if monospace:
+                        named_style.font = openpyxl.styles.Font(name="Courier New", bold=bold)
+                        named_style.alignment = openpyxl.styles.Alignment(wrap_text=True,
+                                                                          vertical="top")
+                    if border:
+                        named_style.border = self.border
+                    if fill is not None:
+                        named_style.fill = self.fill_colours[fill]
+                    self.wb.add_named_style(named_style)
+                self.names[key] = name
+        return self.names[key]
+
+    def format(self, cell, bold=False, border=False, fill=None, named=False):
+        """Format a single cell
+        Args:
+            cell - openpyxl cell
+            bold, border, fill - as self.style()
+            named (bool) - assign named style. Quickest, but also resets
+                           number format, alignment and protection, so
+                           only use for cells in tabs the script created.
+                           Otherwise only the given font/border/fill are set.
+        """
+        if named:
+            cell.style = self.style(bold, border, fill)
+            return
+        if bold:
+            cell.font = self.bold_font
+        if border:
+            cell.border = self.border
+        if fill is not None:
+            cell.fill = self.fill_colours[fill]
+
+    def apply(self, ws, min_row, min_col, max_row, max_col, name):
+        """Apply named style to a range of cells
+        Args:
+            ws - worksheet
+            min_row, min_col, max_row, max_col (int) - range of cells
+            name (str) - style name from self.style()
+        """
+        for cells in ws.iter_rows(min_row=min_row, max_row=max_row,
+                                  min_col=min_col, max_col=max_col):
+            for cell in cells:
+                cell.style = name
+
+
+class FanOut(object):
+    def __init__(self, name, size):
+        """Collects results when a single spreadsheet row is run against a
+        group of databases, so they can be written together when the last
+        one finishes.
+        Args:
+            name (str) - group name (or list of databases) from Database cell
+            size (int) - number of databases in group
+        """
+        self.name = name
+        self.dbchecks = [None] * size
+        self.remaining = size
+        self.lock = threading.Lock()
+
+    def add(self, index, dbcheck):
+        """Add result for one database in group
+        Args:
+            index (int) - position of database in group
+            dbcheck - DbCon object with already fetched results
+        Returns:
+            list of DbCon objects (in group order) if this was the last
+            database to finish, otherwise None
+        """
+        with self.lock:
+            self.dbchecks[index] = dbcheck
+            self.remaining -= 1
+            if self.remaining == 0:
+                return self.dbchecks
+        return None
+
+
+class HostLookup(object):
+    def __init__(self):
+        """Finds host name and IP address of PC. The IP address lookup can
+        take seconds when DNS is misconfigured, so it runs in a background
+        thread while the checks run.
+        """
+        self.hostname = socket.gethostname()
+        self.ipaddr = ""
+        self.thread = threading.Thread(target=self.lookup)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def lookup(self):
+        """Look up IP address of host (run in background thread)"""
+        try:
+            self.ipaddr = socket.gethostbyname(self.hostname)
+        except socket.error:
+            self.ipaddr = "IP address not found"
+
+    def details(self, timeout=None):
+        """Returns host name and IP address, waiting for lookup to finish
+        Args:
+            timeout - optional maximum number of seconds to wait
+        """
+        self.thread.join(timeout)
+        return self.hostname, self.ipaddr or "IP address lookup timed out"
+
+
+# Shared by all spreadsheets in a run so lookup only done once
+_host_lookup = []
+
+
+def host_lookup():
+    """Returns HostLookup object, creating it on first call"""
+    if not _host_lookup:
+        _host_lookup.append(HostLookup())
+    return _host_lookup[0]
+
+
+def load_openpyxl():
+    """Import openpyxl (and the names used from it) on first call"""
+    global openpyxl, column_index_from_string, get_column_letter, IllegalCharacterError
+    if openpyxl is None:
+        import openpyxl as module
+        from openpyxl.utils import column_index_from_string, get_column_letter
+        from openpyxl.utils.exceptions import IllegalCharacterError
+        openpyxl = module
+
+
+def profile_startup():
+    """Print time taken by each part of startup, including import of modules
+    that are only loaded when needed. Used by --profile-startup.
+    """
+    print("Startup profile (seconds)")
+    print("{:<22}{:.3f}".format("script imports", IMPORT_TIME))
+    start = time.time()
+    load_openpyxl()
+    print("{:<22}{:.3f}".format("openpyxl", time.time() - start))
+    for name in ["cx_Oracle", "pyodbc"]:
+        start = time.time()
+        loaded = load_driver(name)
+        elapsed = time.time() - start
+        print("{:<22}{:.3f}{}".format(name, elapsed, "" if loaded else " (not available)"))
+    start = time.time()
+    hostname, ipaddr = host_lookup().details()
+    print("{:<22}{:.3f} ({} - {})".format("host lookup", time.time() - start, hostname, ipaddr))
+
+
+def use_aggregate(params):
+    """Returns True if check's Result Condition is to be checked with a
+    server-side aggregate. Needs Aggregate set to "y...", a Result Condition
+    and no Local Condition (which would otherwise be applied to the counts).
+    Args:
+        params (dict) - check details as read by SpreadsheetRun.read_tab()
+    """
+    return (str(params.get("aggregate", "")).lower()[:1] == "y"
+            and bool(params.get("r_condition")) and not params.get("condition"))
+
+
+def whole_number(value):
+    """Returns value as an int if it's a whole number (e.g. 7, 7.0 or "7")
+    otherwise None"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
 
 def own_name():
     """Returns script's own name
@@ -651,10 +1613,50 @@ if __name__ == "__main__":
 
     filenames = ['queries.xlsx']
 
+    parser = argparse.ArgumentParser(description="Run database checks from spreadsheet(s)")
+    parser.add_argument("filenames", nargs="*",
+                        help="spreadsheet(s) to process (default: " + ", ".join(filenames) + ")")
+    parser.add_argument("--metrics-file",
+                        help="write Prometheus metrics to this file (textfile collector)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics over HTTP on this port during run")
+    parser.add_argument("--metrics-address", default="127.0.0.1",
+                        help="address metrics server listens on (default: 127.0.0.1,"
+                             " use 0.0.0.0 for all interfaces)")
+    parser.add_argument("--metrics-linger", type=float, default=0,
+                        help="seconds to keep serving metrics after run finishes")
+    parser.add_argument("--max-workers", type=int, default=0,
+                        help="run checks with this many worker threads (default: one thread per check)")
+    parser.add_argument("--memory-budget", type=float,
+                        help="MB of query results to hold in memory before moving them to temporary files")
+    parser.add_argument("--adaptive-limit", type=int,
+                        help="adjust number of checks run at once against each database"
+                             " to suit its latency, up to this many")
+    parser.add_argument("--profile-slow", type=float, metavar="SECONDS",
+                        help="write statistics and execution plan of queries taking at least"
+                             " this long to the Slow Queries tab")
+    parser.add_argument("--background-save", action="store_true",
+                        help="write results copy of each spreadsheet in a background process")
+    parser.add_argument("--validate", action="store_true",
+                        help="check spreadsheet(s) for problems without running any queries")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="report time taken by imports and host lookup, then exit")
+    args = parser.parse_args()
+
+    if args.profile_startup:
+        profile_startup()
+        sys.exit()
+
     # Replace spreadsheet filenames with command-line arguments if we have any
-    # (>1 because first argument is this very file so doesn't count)
-    if len(sys.argv) > 1:
-        filenames = sys.argv[1:]
+    if args.filenames:
+        filenames = args.filenames
+
+    # Metrics only collected when they are going to be exposed
+    metrics = None
+    if args.metrics_file or args.metrics_port:
+        metrics = RunMetrics()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port, args.metrics_address)
 
     # Set ODBC Driver (only used if spreadsheet includes ODBC connections)
     ##odbc_driver = 'Oracle in instantclient_12_2'
@@ -664,13 +1666,50 @@ if __name__ == "__main__":
     ##odbc_driver = pyodbc.drivers()[-1]
     odbc_driver = ""
 
+    # Shared by all spreadsheets in run
+    memory_budget = None
+    if args.memory_budget:
+        memory_budget = MemoryBudget(int(args.memory_budget * 1024 * 1024))
+    concurrency_limits = None
+    if args.adaptive_limit:
+        concurrency_limits = AdaptiveLimits(args.adaptive_limit)
+
     # Holds returned response for each spreadsheet
     responses = []
+    # Background processes writing results copies, with index of response
+    # for the spreadsheet
+    save_processes = []
+    # Number of results copies that failed to save in background
+    save_failures = 0
+    # Total number of spreadsheet setup problems found
+    problem_count = 0
 
     # Run the checks from each spreadsheet
     for filename in filenames:
-        go = SpreadsheetRun(filename, odbc_driver)
+        go = SpreadsheetRun(filename, odbc_driver, metrics=metrics,
+                            validate_only=args.validate,
+                            max_workers=args.max_workers,
+                            memory_budget=memory_budget,
+                            background_save=args.background_save,
+                            concurrency_limits=concurrency_limits,
+                            slow_query_time=args.profile_slow)
         responses.append((go.response, go.tab_error_counts))
+        if go.save_process:
+            save_processes.append((go.save_process, len(responses) - 1, go.results_file))
+        problem_count += len(go.problems)
+        # Update metrics file after each spreadsheet
+        if args.metrics_file:
+            metrics.write_textfile(args.metrics_file)
+
+    # Wait for results copies to be written
+    for process, ir, results_file in save_processes:
+        process.join()
+        if process.exitcode != 0:
+            print("***Results copy not saved***:", results_file)
+            save_failures += 1
+            response, tab_errors = responses[ir]
+            responses[ir] = (response.replace("Results saved:", "Results copy FAILED to save:"),
+                             tab_errors)
 
     # List responses and construct info message
     print("\n*** Run Finished ***")
@@ -687,3 +1726,15 @@ if __name__ == "__main__":
         info = info+"\n"
     print(info)
 
+    # Allow final metrics to be scraped before stopping the server
+    if args.metrics_port:
+        time.sleep(args.metrics_linger)
+        metrics.stop()
+
+    # Non-zero exit status when validation finds problems
+    if args.validate and problem_count:
+        sys.exit(1)
+    # Also when a results copy couldn't be saved
+    if save_failures:
+        sys.exit(1)
+
@@ -6,37 +6,112 @@ Can use either cx_Oracle or pyodbc to make the connection
 v0.1 initial version
 """
 from __future__ import print_function
+import decimal
+import importlib
+import threading
 import time
 
+# Holds large results within a memory budget
+from result_spool import ResultSpool
+
+# Number of rows fetched at a time when results held in a ResultSpool
+FETCH_BATCH = 1000
+
+# Oracle queries used by DbCon.profile_last_query()
+# SQL id of the last statement run by this session
+PREV_SQL_SQL = ("SELECT prev_sql_id, prev_child_number FROM v$session"
+                " WHERE sid = SYS_CONTEXT('USERENV', 'SID')")
+# Number of times a cursor has been run (by any session)
+SQL_STATS_SQL = ("SELECT executions FROM v$sql"
+                 " WHERE sql_id = '{}' AND child_number = {}")
+# Statistics of this session so far, taken before and after a query so the
+# difference gives the statistics of that one execution
+SESSION_STATS_SQL = ("SELECT n.name, s.value FROM v$mystat s"
+                     " JOIN v$statname n ON n.statistic# = s.statistic#"
+                     " WHERE n.name IN ('DB time', 'CPU used by this session',"
+                     " 'session logical reads', 'physical reads')")
+# Key in DbCon.profile["stats"] for each session statistic, and multiplier
+# to convert it (times are in centiseconds)
+SESSION_STATS = {"DB time":("db_time", 0.01),
+                 "CPU used by this session":("cpu_time", 0.01),
+                 "session logical reads":("logical_reads", 1),
+                 "physical reads":("physical_reads", 1)}
+# Execution plan actually used for a cursor
+PLAN_SQL = "SELECT plan_table_output FROM TABLE(DBMS_XPLAN.DISPLAY_CURSOR('{}', {}, 'TYPICAL'))"
+
 # Handling for either/or import situaiton as we
-# don't necessarily need both pyodbc and cx_Oracle
+# don't necessarily need both pyodbc and cx_Oracle.
+# Driver modules are only imported when a connection first needs them
+# (see load_driver), so only the driver a spreadsheet actually uses is loaded.
 # Also exception names we later want to handle depend on success
 # of these imports
 FAILED_IMPORTS = []
 DB_EXCEPTIONS = []
 
-try:
-    import pyodbc
-except (ImportError, ModuleNotFoundError) as err:
-    FAILED_IMPORTS.append("pyodbc")
-else:
-    DB_EXCEPTIONS.append(pyodbc.Error)
+# Name of the database exception class in each driver module
+DRIVER_ERRORS = {"pyodbc":"Error", "cx_Oracle":"DatabaseError"}
+
+# cx_Oracle type names for each kind of column (see column_kind()). Both
+# old and new (cx_Oracle 8+) names, only those the module has are used.
+# CHAR columns are left out as they are blank padded.
+COLUMN_TYPES = (("number", ("NUMBER", "NATIVE_FLOAT", "NATIVE_INT",
+                            "DB_TYPE_NUMBER", "DB_TYPE_BINARY_FLOAT",
+                            "DB_TYPE_BINARY_DOUBLE", "DB_TYPE_BINARY_INTEGER")),
+                ("string", ("STRING", "NCHAR", "DB_TYPE_VARCHAR", "DB_TYPE_NVARCHAR")))
+
+# Driver modules already imported (None if import failed)
+_drivers = {}
+_drivers_lock = threading.Lock()
+
+
+def load_driver(name):
+    """Import database driver module on first use
+    Args:
+        name (str) - "pyodbc" or "cx_Oracle"
+    Returns:
+        the module, or None if it could not be imported
+    """
+    with _drivers_lock:
+        if name not in _drivers:
+            try:
+                module = importlib.import_module(name)
+            except ImportError:
+                print("Failed to import db module", name)
+                FAILED_IMPORTS.append(name)
+                module = None
+            else:
+                DB_EXCEPTIONS.append(getattr(module, DRIVER_ERRORS[name]))
+            _drivers[name] = module
+    return _drivers[name]
 
-try:
-    import cx_Oracle
-    from cx_Oracle import DatabaseError
-except (ImportError, ModuleNotFoundError) as err:
-    FAILED_IMPORTS.append("cx_Oracle")
-else:
-    DB_EXCEPTIONS.append(DatabaseError)
 
-if FAILED_IMPORTS == ["pyodbc", "cx_Oracle"]:
-    print("Critical Failure. Failed to import db module.")
+def column_kind(driver, type_code):
+    """Work out kind of values in a column from its cursor.description type
+    Args:
+        driver - driver module (see load_driver())
+        type_code - type from cursor.description, a Python type (pyodbc)
+                    or driver type object (cx_Oracle)
+    Returns:
+        "number", "string" or None if something else or not known
+    """
+    if isinstance(type_code, type):
+        if issubclass(type_code, bool):
+            return None
+        if issubclass(type_code, (int, float, decimal.Decimal)):
+            return "number"
+        if issubclass(type_code, str):
+            return "string"
+        return None
+    for kind, names in COLUMN_TYPES:
+        for name in names:
+            if hasattr(driver, name) and type_code == getattr(driver, name):
+                return kind
+    return None
 
 
 class DbCon(object):
     def __init__(self, username, password, database,
-                 odbc_driver="", do_nothing=False):
+                 odbc_driver="", do_nothing=False, memory_budget=None):
         """
         Create database connection using either pyodbc or cx_Oracle
         (depending on odbc_driver param).
@@ -53,12 +128,19 @@ class DbCon(object):
                                 If None/empty cx_Oracle connection will be
                                 used instead of ODBC.
             do_nothing (bool) - don't automatically make connection if true
+            memory_budget - optional result_spool.MemoryBudget. When set,
+                            results are fetched in batches into a
+                            ResultSpool which moves them to disk once the
+                            budget is used up.
         """
         #Connection type:
         if odbc_driver:
-            self.db_module = pyodbc
+            self.driver_name = "pyodbc"
         else:
-            self.db_module = cx_Oracle
+            self.driver_name = "cx_Oracle"
+        #Driver module - imported by self.open() when first needed
+        self.db_module = None
+        self.cnxn = None
 
         #Holds error messages
         self.errors = []
@@ -66,8 +148,27 @@ class DbCon(object):
         self.results = []
         #Holds column headings
         self.headings = []
+        #Kind of each column of last SQL run by self.execute() (see column_kind())
+        self.column_kinds = []
         #Execution time for query as date/time string (updated by self.runsql()
         self.execution_time = ""
+        #SQL last run by self.runsql()
+        self.sql = ""
+        # Time taken (seconds) to connect and to run query. None until measured
+        self.connect_time = None
+        self.query_time = None
+        #True when results are a server-side aggregate of the query
+        #rather than its rows (set by database_check_excel.py)
+        self.aggregated = False
+        #Statistics and plan from self.profile_last_query() when query
+        #was slow (set by database_check_excel.py)
+        self.profile = None
+        #When True self.runsql() takes a snapshot of session statistics
+        #before running query, for self.profile_last_query()
+        #(set by database_check_excel.py)
+        self.snapshot_stats = False
+        self.stats_before = None
+        self.memory_budget = memory_budget
         self.database = database
 
         # Construct connection string
@@ -98,13 +199,22 @@ class DbCon(object):
 
     def open(self):
         """Open and test database connection"""
+        #Can't connect without the driver module
+        self.db_module = load_driver(self.driver_name)
+        if not self.db_module:
+            self.cnxn = None
+            self.errors.append("Can't connect because " + self.driver_name
+                               + " module could not be imported.")
+            return
         #Try to make database connection using connection string
+        start = time.time()
         try:
             self.cnxn = self.db_module.connect(self.constring)
         # DatabaseError - cx_Oracle, pyodbc.Error - pyodbc
-        except (DatabaseError, pyodbc.Error) as err:
+        except getattr(self.db_module, DRIVER_ERRORS[self.driver_name]) as err:
             self.cnxn = None
             self.errors.append(str(err))
+        self.connect_time = time.time() - start
 
     def close(self):
         """If connection exists, close it"""
@@ -119,17 +229,25 @@ class DbCon(object):
             params - optional container of sql substitution parameters
         """
         self.execution_time = time.strftime("%d-%b-%Y %H:%M:%S")
+        self.sql = sql
         #Don't run if there's no connection
         if not self.cnxn:
             self.errors.append("Can't execute SQL because no connection.")
         else:
+            self.clear_results()
+            if self.snapshot_stats:
+                self.stats_before = self.session_stats()
+            start = time.time()
             self.results, self.headings, self.errors = self.execute(sql, params)
+            self.query_time = time.time() - start
 
-    def execute(self, sql, params=()):
+    def execute(self, sql, params=(), spool=True):
         """Execute sql using current connection and retrieve results
         Args:
             sql - sql to execute
             params - optional subsitution parameters if format valid for cx_Oracle
+            spool (bool) - optional, set False to always return results as a
+                           list even if self.memory_budget set
         Returns:
             SQL query result (list of tuples)
             Column headings (list of strings)
@@ -150,14 +268,95 @@ class DbCon(object):
         else:
             #SQL exececution successful - retrieve results
             try:
-                rows = cursor.fetchall()
+                if self.memory_budget and spool:
+                    rows = ResultSpool(self.memory_budget)
+                    batch = cursor.fetchmany(FETCH_BATCH)
+                    while batch:
+                        rows.extend(batch)
+                        batch = cursor.fetchmany(FETCH_BATCH)
+                else:
+                    rows = cursor.fetchall()
             except Exception as err:
                 local_errors.append("Error on fetching results:" + str(err))
             else:
                 #Also capture column headings
                 headings = [d[0] for d in cursor.description]
+                self.column_kinds = [column_kind(self.db_module, d[1]) if len(d) > 1 else None
+                                     for d in cursor.description]
         return rows, headings, local_errors
 
+    def clear_results(self):
+        """Free memory/disk space used by results once no longer needed"""
+        if isinstance(self.results, ResultSpool):
+            self.results.close()
+        self.results = []
+
+    def session_stats(self):
+        """Get statistics of this session so far from v$mystat
+        Returns:
+            dict of statistic name and value (see SESSION_STATS)
+            Error messages (list of strings)
+        """
+        rows, headings, errors = self.execute(SESSION_STATS_SQL, spool=False)
+        return {name:value for name, value in rows}, errors
+
+    def profile_last_query(self):
+        """Get statistics and execution plan of the last SQL run by
+        self.runsql() using the current connection. Statistics are for that
+        one execution, the difference between v$mystat before the query
+        (needs self.snapshot_stats set when query run) and now. Also uses
+        v$session, v$sql and DBMS_XPLAN. Must be called before anything
+        else is run on the connection. Needs access to these views (e.g.
+        SELECT_CATALOG_ROLE).
+        Returns:
+            dict with keys:
+            sql_id (str) - Oracle SQL id of the query
+            stats (dict) - DB and CPU time (seconds), logical reads and
+                           physical reads of this execution, rows fetched
+                           and number of times cursor has been run
+            plan (list) - lines of the execution plan
+            errors (list) - error messages if any of the above not found
+        """
+        profile = {"sql_id":"", "stats":{}, "plan":[], "errors":[]}
+        if not self.cnxn:
+            profile["errors"].append("Can't profile query because no connection.")
+            return profile
+        rows, headings, errors = self.execute(PREV_SQL_SQL, spool=False)
+        # Snapshot after query. Only taken now as v$session above must be
+        # the first thing run after query (its own small use is included)
+        stats_after, stats_errors = self.session_stats()
+        profile["stats"]["rows_fetched"] = len(self.results)
+        if self.stats_before is None:
+            profile["errors"].append("Session statistics not taken before query.")
+        elif self.stats_before[1] or stats_errors:
+            profile["errors"].extend(self.stats_before[1] or stats_errors)
+        else:
+            for name, (key, scale) in SESSION_STATS.items():
+                if name in stats_after and name in self.stats_before[0]:
+                    profile["stats"][key] = (stats_after[name] - self.stats_before[0][name]) * scale
+
+        if errors or not rows or not rows[0][0]:
+            profile["errors"].extend(errors or ["SQL id of query not found."])
+            return profile
+        sql_id, child = str(rows[0][0]), int(rows[0][1] or 0)
+        # SQL id is used in queries below so make sure it's just letters/digits
+        if not sql_id.isalnum():
+            profile["errors"].append("Unexpected SQL id " + sql_id)
+            return profile
+        profile["sql_id"] = sql_id
+
+        rows, headings, errors = self.execute(SQL_STATS_SQL.format(sql_id, child), spool=False)
+        profile["errors"].extend(errors)
+        if rows:
+            profile["stats"]["executions"] = rows[0][0]
+        elif not errors:
+            profile["errors"].append("Statistics not found for SQL id " + sql_id)
+
+        rows, headings, errors = self.execute(PLAN_SQL.format(sql_id, child), spool=False)
+        profile["errors"].extend(errors)
+        profile["plan"] = [row[0] for row in rows if row[0] is not None]
+        return profile
+
     def db_info(self):
         """Get some info from v$database
         Return details if found
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Hold query result rows within a memory budget shared by all the queries in a
+run. Rows are kept in memory while the budget allows and moved to a temporary
+sqlite file when it doesn't, then read back from there when the results are
+written to the spreadsheet.
+
+v0.1 initial version
+"""
+from __future__ import print_function
+import os
+import pickle
+import sqlite3
+import sys
+import tempfile
+import threading
+
+# Number of rows read back from spill file at a time
+READ_BATCH = 1000
+
+
+class MemoryBudget(object):
+    def __init__(self, limit):
+        """Allowance of memory for result rows, shared between threads
+        Args:
+            limit (int) - number of bytes allowed
+        """
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, size):
+        """Reserve size bytes. Returns True if they fit within the budget"""
+        with self.lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        """Give back previously reserved bytes"""
+        with self.lock:
+            self.used -= size
+
+
+class ResultSpool(object):
+    def __init__(self, budget):
+        """List-like store of result rows (supports len(), iteration and
+        indexing). Rows held in memory until budget is used up, after which
+        all rows are moved to a temporary sqlite file.
+        Args:
+            budget - MemoryBudget object
+        """
+        self.budget = budget
+        self.rows = []
+        # Bytes reserved from budget for self.rows
+        self.reserved = 0
+        self.count = 0
+        # sqlite connection and filename once spilled to disk
+        self.db = None
+        self.filename = ""
+
+    def extend(self, rows):
+        """Add rows (list of tuples)"""
+        if not rows:
+            return
+        if self.db is None:
+            size = estimate_size(rows)
+            if self.budget.reserve(size):
+                self.rows.extend(rows)
+                self.reserved += size
+                self.count += len(rows)
+                return
+            self.spill()
+        self.extend_disk(rows)
+
+    def spill(self):
+        """Move rows held in memory to temporary sqlite file"""
+        handle, self.filename = tempfile.mkstemp(prefix="dbcheck_", suffix=".sqlite")
+        os.close(handle)
+        # Rows may be added by a check thread and read by the writer thread
+        self.db = sqlite3.connect(self.filename, check_same_thread=False)
+        self.db.execute("CREATE TABLE rows (seq INTEGER PRIMARY KEY, data BLOB)")
+        rows, self.rows, self.count = self.rows, [], 0
+        self.budget.release(self.reserved)
+        self.reserved = 0
+        self.extend_disk(rows)
+
+    def extend_disk(self, rows):
+        """Add rows straight to sqlite file"""
+        self.db.executemany("INSERT INTO rows (seq, data) VALUES (?, ?)",
+                            [(self.count + i, pickle.dumps(row, pickle.HIGHEST_PROTOCOL))
+                             for i, row in enumerate(rows)])
+        self.count += len(rows)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        if self.db is None:
+            for row in self.rows:
+                yield row
+            return
+        for start in range(0, self.count, READ_BATCH):
+            cursor = self.db.execute("SELECT data FROM rows WHERE seq >= ? AND seq < ? ORDER BY seq",
+                                     (start, start + READ_BATCH))
+            for (data,) in cursor.fetchall():
+                yield pickle.loads(data)
+
+    def __getitem__(self, index):
+        if self.db is None:
+            return self.rows[index]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("ResultSpool index out of range")
+        (data,) = self.db.execute("SELECT data FROM rows WHERE seq = ?", (index,)).fetchone()
+        return pickle.loads(data)
+
+    def close(self):
+        """Free memory budget and delete spill file"""
+        self.budget.release(self.reserved)
+        self.reserved = 0
+        self.rows = []
+        self.count = 0
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+            os.remove(self.filename)
+
+
+def estimate_size(rows):
+    """Rough number of bytes used by list of row tuples"""
+    return sum(sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+               for row in rows)
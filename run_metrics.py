@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+Collect check results and run metrics from database_check_excel.py and expose
+them in Prometheus/OpenMetrics text format, either by writing a file for the
+node_exporter textfile collector or by serving them over a local HTTP endpoint.
+
+v0.1 initial version
+"""
+from __future__ import print_function
+import os
+import threading
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class RunMetrics(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Thread-safe store of the metrics produced during a run.
+        Check threads record results and latencies, the main thread records
+        queue depth, workbook durations and tab error counts.
+        Args:
+            buckets - upper bounds (seconds) for latency histogram buckets
+        """
+        self.lock = threading.Lock()
+        self.buckets = tuple(sorted(buckets))
+        # (workbook, tab, row, database, username) -> (ok, outcome)
+        self.check_status = {}
+        # (database, phase) -> [bucket counts list, sum, count]
+        self.latencies = {}
+        # (workbook, tab) -> error count
+        self.tab_errors = {}
+        # workbook -> run duration in seconds
+        self.run_durations = {}
+        # workbook -> save duration in seconds
+        self.save_durations = {}
+        # database -> current adaptive concurrency limit
+        self.concurrency_limits = {}
+        self.queue_depth = 0
+        self.active_workers = 0
+        # Holds HTTP server when self.serve() used
+        self.server = None
+
+    def record_check(self, workbook, tab, row, database, username, outcome):
+        """Record the outcome of a single check
+        Args:
+            workbook (str) - spreadsheet filename
+            tab (str) - query tab name
+            row (int) - row number of check on query tab
+            database (str) - database name
+            username (str) - database username
+            outcome (str) - "pass", "error", "condition_failed" or
+                            "condition_exception"
+        """
+        key = (workbook, tab, str(row), database, username)
+        with self.lock:
+            self.check_status[key] = (int(outcome == "pass"), outcome)
+
+    def observe_latency(self, database, phase, seconds):
+        """Add a latency observation to the histogram for database/phase
+        Args:
+            database (str) - database name
+            phase (str) - "connect" or "query"
+            seconds (float) - observed latency
+        """
+        if seconds is None:
+            return
+        with self.lock:
+            entry = self.latencies.setdefault((database, phase),
+                                              [[0] * len(self.buckets), 0.0, 0])
+            for bi, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry[0][bi] += 1
+            entry[1] += seconds
+            entry[2] += 1
+
+    def set_queue_depth(self, depth):
+        """Record number of checks waiting in the queue"""
+        with self.lock:
+            self.queue_depth = depth
+
+    def set_concurrency_limit(self, database, limit):
+        """Record current adaptive concurrency limit for database"""
+        with self.lock:
+            self.concurrency_limits[database] = limit
+
+    def worker_started(self):
+        """Note that a check worker has become active"""
+        with self.lock:
+            self.active_workers += 1
+
+    def worker_finished(self):
+        """Note that a check worker has finished"""
+        with self.lock:
+            self.active_workers -= 1
+
+    def record_workbook(self, workbook, duration, tab_error_counts):
+        """Record run duration and tab error counts at end of a workbook run
+        Args:
+            workbook (str) - spreadsheet filename
+            duration (float) - run time in seconds
+            tab_error_counts (dict) - number of errors for each tab
+        """
+        with self.lock:
+            self.run_durations[workbook] = duration
+            for tab, errors in tab_error_counts.items():
+                self.tab_errors[(workbook, tab)] = errors
+
+    def record_save(self, workbook, duration):
+        """Record time taken to save workbook
+        Args:
+            workbook (str) - spreadsheet filename
+            duration (float) - save time in seconds
+        """
+        with self.lock:
+            self.save_durations[workbook] = duration
+
+    def render(self):
+        """Returns the metrics in Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            lines.extend(metric_header("dbcheck_check_ok", "gauge",
+                                       "1 if the check passed, 0 otherwise."))
+            for key, (ok, outcome) in sorted(self.check_status.items()):
+                labels = zip(("workbook", "tab", "row", "database", "username"), key)
+                labels = list(labels) + [("outcome", outcome)]
+                lines.append(sample("dbcheck_check_ok", labels, ok))
+
+            lines.extend(metric_header("dbcheck_db_latency_seconds", "histogram",
+                                       "Database connect and query latency."))
+            for (database, phase), (counts, total, count) in sorted(self.latencies.items()):
+                labels = [("database", database), ("phase", phase)]
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(sample("dbcheck_db_latency_seconds_bucket",
+                                        labels + [("le", format_value(bound))],
+                                        bucket_count))
+                lines.append(sample("dbcheck_db_latency_seconds_bucket",
+                                    labels + [("le", "+Inf")], count))
+                lines.append(sample("dbcheck_db_latency_seconds_sum", labels, total))
+                lines.append(sample("dbcheck_db_latency_seconds_count", labels, count))
+
+            lines.extend(metric_header("dbcheck_tab_errors", "gauge",
+                                       "Number of non-green results on each query tab."))
+            for (workbook, tab), errors in sorted(self.tab_errors.items()):
+                lines.append(sample("dbcheck_tab_errors",
+                                    [("workbook", workbook), ("tab", tab)], errors))
+
+            lines.extend(metric_header("dbcheck_run_duration_seconds", "gauge",
+                                       "Time taken to run each workbook."))
+            for workbook, duration in sorted(self.run_durations.items()):
+                lines.append(sample("dbcheck_run_duration_seconds",
+                                    [("workbook", workbook)], duration))
+
+            lines.extend(metric_header("dbcheck_save_duration_seconds", "gauge",
+                                       "Time taken to save each workbook."))
+            for workbook, duration in sorted(self.save_durations.items()):
+                lines.append(sample("dbcheck_save_duration_seconds",
+                                    [("workbook", workbook)], duration))
+
+            lines.extend(metric_header("dbcheck_concurrency_limit", "gauge",
+                                       "Checks allowed to run at once against each database."))
+            for database, limit in sorted(self.concurrency_limits.items()):
+                lines.append(sample("dbcheck_concurrency_limit",
+                                    [("database", database)], limit))
+
+            lines.extend(metric_header("dbcheck_queue_depth", "gauge",
+                                       "Checks waiting to be run."))
+            lines.append(sample("dbcheck_queue_depth", [], self.queue_depth))
+            lines.extend(metric_header("dbcheck_active_workers", "gauge",
+                                       "Check threads currently running."))
+            lines.append(sample("dbcheck_active_workers", [], self.active_workers))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Write metrics to file for node_exporter textfile collector.
+        Written to temporary file then renamed so collector never sees
+        a partial file.
+        Args:
+            path (str) - filename, should end with .prom
+        """
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as out:
+            out.write(self.render())
+        os.replace(temp_path, path)
+
+    def serve(self, port, address="127.0.0.1"):
+        """Serve metrics over HTTP (any path) from a background thread
+        Args:
+            port (int) - port number
+            address (str) - optional address to bind to (default local
+                            only, as labels include database names and
+                            usernames)
+        """
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                """Don't report each scrape on the console"""
+                pass
+
+        self.server = HTTPServer((address, port), MetricsHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Stop the HTTP server if running"""
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def metric_header(name, metric_type, help_text):
+    """Returns HELP and TYPE lines for a metric"""
+    return ["# HELP {} {}".format(name, help_text),
+            "# TYPE {} {}".format(name, metric_type)]
+
+
+def sample(name, labels, value):
+    """Returns a single sample line
+    Args:
+        name (str) - metric name
+        labels - sequence of (label name, label value) pairs
+        value - numeric value
+    """
+    if labels:
+        label_text = ",".join('{}="{}"'.format(k, escape_label(v)) for k, v in labels)
+        return "{}{{{}}} {}".format(name, label_text, format_value(value))
+    return "{} {}".format(name, format_value(value))
+
+
+def escape_label(value):
+    """Escape label value as required by the exposition format"""
+    return (str(value).replace("\\", "\\\\")
+            .replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+def format_value(value):
+    """Format number without unnecessary trailing .0"""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# Example output
+if __name__ == "__main__":
+    metrics = RunMetrics()
+    metrics.record_check("queries.xlsx", "Set1", 7, "caxton", "user1", "pass")
+    metrics.observe_latency("caxton", "connect", 0.3)
+    metrics.observe_latency("caxton", "query", 1.2)
+    metrics.record_workbook("queries.xlsx", 4.5, {"Set1": 0})
+    print(metrics.render())